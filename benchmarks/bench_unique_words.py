@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of merging words from overlapping wordsets.
+Compares the previous linear scan with the id-indexed merge of lingualeoanki/wordlist.py.
+
+Usage: python benchmarks/bench_unique_words.py
+"""
+import os
+import random
+import timeit
+
+WORDLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lingualeoanki', 'wordlist.py')
+
+
+def load_wordlist():
+    """
+    The add-on package can't be imported outside Anki, so the module is loaded by its path
+    """
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('wordlist', WORDLIST_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('wordlist', WORDLIST_PATH)
+
+
+wordlist = load_wordlist()
+
+SIZES = [1000, 5000, 10000, 50000, 100000]
+# Linear scan takes minutes on larger lists
+MAX_LINEAR_SIZE = 10000
+
+
+def linear_unique_words(word_lists):
+    words = []
+    for more_words in word_lists:
+        for check_word in more_words:
+            if all(word['id'] != check_word['id'] for word in words):
+                words.append(check_word)
+    return words
+
+
+def make_word_lists(size):
+    """
+    Main dictionary of size words and two wordsets that repeat a half of it
+    """
+    main = [{'id': i, 'wordValue': 'word%d' % i, 'wordLemmaId': i // 2} for i in range(size)]
+    wordsets = [random.sample(main, size // 4), random.sample(main, size // 4)]
+    return wordsets + [main]
+
+
+def measure(func, word_lists):
+    return min(timeit.repeat(lambda: func(word_lists), number=1, repeat=3))
+
+
+def main():
+    random.seed(0)
+    print('{:>8} {:>12} {:>12} {:>12}'.format('words', 'linear, s', 'by id, s', 'by lemma, s'))
+    for size in SIZES:
+        word_lists = make_word_lists(size)
+        expected = wordlist.get_unique_words(word_lists)
+        assert len(expected) == size
+        linear = '-'
+        if size <= MAX_LINEAR_SIZE:
+            assert linear_unique_words(word_lists) == expected
+            linear = '{:.4f}'.format(measure(linear_unique_words, word_lists))
+        by_id = measure(wordlist.get_unique_words, word_lists)
+        by_lemma = measure(lambda lists: wordlist.get_unique_words(lists, by_lemma=True), word_lists)
+        print('{:>8} {:>12} {:>12.4f} {:>12.4f}'.format(size, linear, by_id, by_lemma))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,636 @@
+"""
+Alternative engine based on asyncio (Anki 2.1 only).
+All requests of the add-on run as coroutines on one event loop in a background thread,
+so authorization, requests for wordsets and words and media downloads
+share a few keep-alive connections instead of occupying a thread each.
+Objects have the same signals and slots as the ones in connect module.
+"""
+import asyncio
+import io
+import socket
+import ssl
+import threading
+import time
+
+from .six.moves import http_client
+from .six.moves import urllib
+
+from aqt.qt import *
+from . import brokenlinks
+from . import codec
+from . import connect
+from . import retry
+from . import snapshot
+from . import transport
+from . import utils
+from . import wordlist
+
+
+# Bodies of responses are read by parts of this size
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class EventLoopThread(object):
+    """
+    Runs asyncio event loop in a daemon thread
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Schedule coroutine from any thread
+        :return: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+_loop_thread = None
+_loop_thread_lock = threading.Lock()
+
+
+def get_event_loop_thread():
+    """
+    Event loop is shared by all objects of the engine and lives until Anki is closed
+    """
+    global _loop_thread
+    with _loop_thread_lock:
+        if _loop_thread is None:
+            _loop_thread = EventLoopThread()
+        return _loop_thread
+
+
+class AsyncConnectionPool(transport.ConnectionPool):
+    """
+    ConnectionPool for the event loop: connections are asyncio streams,
+    and not more than max_per_host connections to one host are used at a time.
+    Must be used only from the event loop thread.
+    Requests to the hosts behind a proxy are sent by transport.ConnectionPool in the executor threads.
+    """
+    def __init__(self, cookie_jar=None, context=None, timeout=None, max_per_host=4):
+        transport.ConnectionPool.__init__(self, cookie_jar, context, timeout, max_per_host)
+        self._slots = {}
+        self.proxy_pool = None
+
+    def close(self):
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+        if self.proxy_pool is not None:
+            # Next one is created with the current context
+            self.proxy_pool.close()
+            self.proxy_pool = None
+
+    def get_stats(self):
+        stats = transport.ConnectionPool.get_stats(self)
+        if self.proxy_pool is not None:
+            for name, value in self.proxy_pool.get_stats().items():
+                stats[name] += value
+        return stats
+
+    async def open(self, request, sink=None):
+        """
+        Send request and read the whole response.
+        :param request: url string or urllib.request.Request
+        :param sink: function that receives parts of the body of a successful response as they arrive,
+                     instead of keeping the body in the response (e.g. to write a media file)
+        :return: transport.Response
+        """
+        if not isinstance(request, urllib.request.Request):
+            request = urllib.request.Request(request)
+        if self.get_proxy(transport.get_connection_key(request.get_full_url())):
+            response = await self.open_with_proxy(request)
+            if sink:
+                sink(response.read())
+            return response
+        for _ in range(transport.MAX_REDIRECTS + 1):
+            response = await self._open_once(request, sink)
+            if response.status not in transport.REDIRECT_CODES or not response.headers.get('Location'):
+                break
+            request = transport.get_redirect_request(request, response)
+        transport.raise_for_status(response)
+        return response
+
+    async def open_with_proxy(self, request):
+        """
+        Tunneling through a proxy is left to http client, which blocks, so it runs in the executor
+        """
+        if self.proxy_pool is None:
+            self.proxy_pool = transport.ConnectionPool(self.cookie_jar, self.context, self.timeout,
+                                                       self.max_idle_per_host)
+        return await asyncio.get_event_loop().run_in_executor(None, self.proxy_pool.open, request)
+
+    async def _open_once(self, request, sink=None):
+        url = request.get_full_url()
+        method = request.get_method()
+        key, path, headers, data = self.prepare_request(request)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = asyncio.Semaphore(self.max_idle_per_host)
+        async with slot:
+            start = time.time()
+            connection, reused = await self._acquire_stream(key)
+            try:
+                result = await self._exchange(connection, method, path, data, headers, sink)
+            except (urllib.error.URLError, socket.error) as e:
+                connection[1].close()
+                if not reused or not transport.is_stale_connection_error(e):
+                    # Timeout means the server may be still processing the request, it's not sent again
+                    raise
+                # Server has closed idle connection, repeat once with a fresh one
+                connection, reused = await self._connect(key), False
+                result = await self._exchange(connection, method, path, data, headers, sink)
+            status, reason, message, raw_body, raw_size, will_close = result
+            if will_close:
+                connection[1].close()
+            else:
+                self._idle.setdefault(key, []).append(connection)
+            elapsed = time.time() - start
+
+        body = transport.decode_body(raw_body, message.get('Content-Encoding'))
+        response = transport.Response(url, status, reason, message, body, reused, raw_size, elapsed)
+        self.process_response(request, response)
+        return response
+
+    async def _acquire_stream(self, key):
+        connections = self._idle.get(key)
+        while connections:
+            reader, writer = connections.pop()
+            if not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+        return await self._connect(key), False
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        kwargs = {}
+        if scheme == 'https':
+            kwargs['ssl'] = self.context if self.context is not None else ssl.create_default_context()
+            kwargs['server_hostname'] = host
+        port = port or (443 if scheme == 'https' else 80)
+        try:
+            connection = await asyncio.wait_for(asyncio.open_connection(host, port, **kwargs), self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+        with self._lock:
+            self.stats['opened'] += 1
+        return connection
+
+    async def _exchange(self, connection, method, path, data, headers, sink=None):
+        try:
+            return await asyncio.wait_for(self._do_exchange(connection, method, path, data, headers, sink),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+        except (asyncio.IncompleteReadError, http_client.HTTPException, ValueError) as e:
+            # Callers expect urllib exceptions, as with the other transport
+            raise urllib.error.URLError(e)
+
+    @staticmethod
+    async def _do_exchange(connection, method, path, data, headers, sink=None):
+        """
+        Minimal HTTP/1.1 exchange over a keep-alive connection
+        :param sink: function to pass the parts of uncompressed body of a successful response to
+        :return: tuple of status, reason, headers, raw body (empty if it was passed to sink), size of raw body
+                 and flag if connection will be closed
+        """
+        reader, writer = connection
+        headers = dict(headers)
+        if data is not None:
+            headers['Content-Length'] = str(len(data))
+        lines = ['{} {} HTTP/1.1'.format(method, path)]
+        lines += ['{}: {}'.format(name, value) for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b''))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Remote end closed connection without response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        message = http_client.parse_headers(io.BytesIO(b''.join(header_lines)))
+
+        will_close = version == 'HTTP/1.0' or message.get('Connection', '').lower() == 'close'
+        chunks = []
+        size = 0
+        # Compressed body is decoded as a whole, so it's not streamed
+        is_streamed = sink and 200 <= status < 300 and \
+            (message.get('Content-Encoding') or 'identity').strip().lower() == 'identity'
+
+        def write(chunk):
+            nonlocal size
+            size += len(chunk)
+            if is_streamed:
+                sink(chunk)
+            else:
+                chunks.append(chunk)
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            pass
+        elif 'chunked' in message.get('Transfer-Encoding', '').lower():
+            await read_chunked(reader, write)
+        elif message.get('Content-Length') is not None:
+            await read_exactly(reader, int(message.get('Content-Length')), write)
+        else:
+            await read_to_eof(reader, write)
+            will_close = True
+        body = b''.join(chunks)
+        if sink and 200 <= status < 300 and not is_streamed:
+            sink(transport.decode_body(body, message.get('Content-Encoding')))
+            body = b''
+        return status, reason, message, body, size, will_close
+
+
+async def read_chunked(reader, write):
+    while True:
+        size_line = await reader.readline()
+        size = int(size_line.split(b';')[0].strip(), 16)
+        if size == 0:
+            # Skip trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return
+        await read_exactly(reader, size, write)
+        await reader.readexactly(2)
+
+
+async def read_exactly(reader, size, write):
+    """
+    Pass size bytes to write by parts, not keeping all of them in memory
+    """
+    while size > 0:
+        chunk = await reader.read(min(size, STREAM_CHUNK_SIZE))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b'', size)
+        write(chunk)
+        size -= len(chunk)
+
+
+async def read_to_eof(reader, write):
+    while True:
+        chunk = await reader.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        write(chunk)
+
+
+class AsyncLingualeo(connect.Lingualeo):
+    """
+    Lingualeo with requests running as coroutines.
+    Slots only schedule the work on the event loop and return immediately.
+    """
+    def __init__(self, email, password, cookies_path=None, parent=None):
+        connect.Lingualeo.__init__(self, email, password, cookies_path, parent)
+        self.loop_thread = get_event_loop_thread()
+        self.transport = AsyncConnectionPool(self.cj, timeout=self.API_TIMEOUT, max_per_host=self.API_CONCURRENCY)
+        self.async_auth_lock = None
+        self.tasks = set()
+
+    def run(self, coroutine):
+        task = self.loop_thread.submit(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def cancel_tasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    @pyqtSlot()
+    def authorize(self):
+        self.run(self.authorize_async())
+
+    @pyqtSlot(str)
+    def get_wordsets(self, status):
+        self.run(self.get_wordsets_async(status))
+
+    @pyqtSlot(str, list, bool, bool)
+    def get_words_to_add(self, status, wordsets, with_context=False, only_new=False):
+        self.run(self.get_words_to_add_async(status, wordsets, with_context, only_new))
+
+    async def authorize_async(self):
+        self.Busy.emit(True)
+        self.AuthorizationStatus.emit(await self.get_connection_async())
+        self.Busy.emit(False)
+
+    async def get_connection_async(self):
+        msg = ''
+        try:
+            if self.is_session_valid():
+                return True
+            if not await self.is_authorized_async():
+                status = await self.auth_async()
+                if status.get('error_msg'):
+                    msg = status['error_msg']
+        except Exception as e:
+            if connect.is_connection_error(e) and self.try_ssl_fix(e):
+                return await self.get_connection_async()
+            msg = connect.get_connection_error_message(e)
+        if msg:
+            self.Error.emit(msg)
+            return False
+        return True
+
+    async def get_wordsets_async(self, status):
+        self.Busy.emit(True)
+        wordsets = []
+        msg = ''
+        if not await self.get_connection_async():
+            self.Wordsets.emit(wordsets)
+            self.Busy.emit(False)
+            return
+        try:
+            response = await self.get_api_content_async(connect.WORDSETS_URL, connect.get_wordsets_request(),
+                                                        use_cache=True)
+            wordsets = connect.parse_wordsets(response, status)
+            self.save_cookies()
+            if not wordsets:
+                msg = 'No user dictionaries found'
+        except Exception as e:
+            msg = connect.get_wordsets_error_message(e)
+        if msg:
+            self.Error.emit(msg)
+            wordsets = []
+
+        self.Wordsets.emit(wordsets)
+        self.Busy.emit(False)
+
+    async def get_words_to_add_async(self, status, wordsets, with_context, only_new):
+        self.Busy.emit(True)
+        words = []
+        msg = ''
+        if not await self.get_connection_async():
+            self.Words.emit(words)
+            self.Busy.emit(False)
+            return
+        self.start_words_request(wordsets, only_new)
+        try:
+            get_func = self.get_words_with_context_async if with_context else self.get_words_async
+            wordset_ids = wordsets if wordsets else [1]
+            # Wordsets are requested simultaneously, but merged in the order they were chosen
+            all_received = await asyncio.gather(*[get_func(status, wordset_id) for wordset_id in wordset_ids])
+            words = wordlist.get_unique_words(all_received, self.MERGE_BY_LEMMA)
+            self.save_cookies()
+            self.pager.save()
+            self.ConnectionStats.emit(self.transport.format_stats())
+        except Exception as e:
+            msg = connect.get_words_error_message(e)
+        if msg:
+            self.Error.emit(msg)
+            words = []
+            self.snapshot.discard()
+
+        self.Words.emit(words)
+        self.Busy.emit(False)
+
+    async def get_words_async(self, status, wordset_id):
+        values = self.get_words_request(status, wordset_id)
+        date_groups = connect.get_date_groups(await self.get_word_groups_async(values))
+        self.add_date_groups_progress(date_groups)
+
+        key = snapshot.get_key(wordset_id, status)
+        if self.only_new and connect.is_ordered_by_creation(status, wordset_id):
+            words = await self.get_new_words_async(values, date_groups, key)
+            return self.snapshot.stage_words(key, words)
+        groups_words = await asyncio.gather(*[self.get_date_group_words_async(values, *date_group)
+                                              for date_group in date_groups])
+        words = [word for words in groups_words for word in words]
+        changed_words = self.snapshot.stage_words(key, words)
+        return changed_words if self.only_new else words
+
+    async def get_new_words_async(self, values, date_groups, key):
+        words = []
+        for date_group, group_count, group_words in date_groups:
+            if not self.snapshot.is_known_territory(key, group_words):
+                group_words = await self.get_date_group_words_async(
+                    values, date_group, group_count, group_words,
+                    lambda chunk: self.snapshot.is_known_territory(key, chunk))
+            words += group_words
+            if self.snapshot.is_known_territory(key, group_words):
+                break
+        return words
+
+    async def get_date_group_words_async(self, values, date_group, group_count, words, stop_at=None):
+        words = list(words)
+        while group_count is None or len(words) < group_count:
+            page_values = connect.get_page_request(values, date_group, words, self.pager.get_size())
+            word_chunk = connect.get_group_words(await self.get_word_groups_async(page_values), date_group)
+            if not word_chunk:
+                break
+            words += word_chunk
+            self.add_words_progress(len(word_chunk), 0)
+            if len(word_chunk) < page_values['perPage'] or (stop_at and stop_at(word_chunk)):
+                break
+        return words
+
+    async def get_word_groups_async(self, values):
+        response = await self.get_words_page_async(values, use_cache=not self.only_new)
+        return connect.parse_word_groups(response)
+
+    async def get_words_page_async(self, values, use_cache=False):
+        page_info = {}
+        try:
+            content = await self.get_api_content_async(connect.WORDS_URL, values, use_cache, page_info)
+        except socket.timeout:
+            if not self.reduce_page_size(values):
+                raise
+            return await self.get_words_page_async(values, use_cache)
+        self.record_page(values, content, page_info)
+        return content
+
+    async def get_words_with_context_async(self, status, wordset_id):
+        values = self.get_context_words_request(status, wordset_id)
+        words = []
+        next_chunk = (await self.get_words_page_async(values)).get('data')
+        while next_chunk:
+            words += next_chunk
+            values['offset'] = {'wordId': next_chunk[-1].get('id')}
+            values['perPage'] = self.pager.get_size()
+            next_chunk = (await self.get_words_page_async(values)).get('data')
+        return self.stage_context_words(status, wordset_id, words)
+
+    # Low level methods
+    #########################
+
+    async def auth_async(self):
+        content = await self.get_content_async(*self.get_auth_request())
+        self.process_auth(content)
+        return content
+
+    async def is_authorized_async(self):
+        response = await self.transport.open(self.url_prefix + connect.ISAUTHORIZED_URL)
+        return self.process_is_authorized(response)
+
+    async def get_api_content_async(self, url, values, use_cache=False, page_info=None):
+        if use_cache and self.cache:
+            content = self.get_fresh_cached_content(url, values)
+            if content is not None:
+                return content
+        get_func = self.get_cached_content_async if use_cache and self.cache else self.get_content_async
+        generation = self.session_generation
+        try:
+            content = await get_func(url, values, page_info=page_info)
+            is_rejected = connect.is_authorization_error(content.get('error'))
+        except urllib.error.HTTPError as e:
+            if e.code not in (401, 403):
+                raise
+            is_rejected = True
+        except (urllib.error.URLError, socket.error) as e:
+            if not self.try_ssl_fix(e):
+                raise
+            return await self.get_api_content_async(url, values, use_cache, page_info)
+        if not is_rejected:
+            self.mark_session_valid()
+            return content
+        await self.reauthorize_async(generation)
+        return await get_func(url, values, page_info=page_info)
+
+    async def reauthorize_async(self, generation):
+        if self.async_auth_lock is None:
+            self.async_auth_lock = asyncio.Lock()
+        async with self.async_auth_lock:
+            if generation != self.session_generation:
+                return
+            self.invalidate_session()
+            status = await self.auth_async()
+            if status.get('error_msg'):
+                raise Exception(status['error_msg'])
+            self.session_generation += 1
+
+    async def get_cached_content_async(self, url, values, page_info=None):
+        key = self.cache.get_key(self.email, url, values)
+        entry = self.cache.get(key)
+        response = await self.request_content_async(url, values, entry.get_validators() if entry else None,
+                                                    page_info)
+        if response.status == 304 and entry:
+            self.cache.refresh(key, response.headers)
+            return codec.loads(entry.body)
+        content = codec.loads(response.read())
+        if not content.get('error'):
+            self.cache.put(key, response.read(), response.headers)
+        return content
+
+    async def get_content_async(self, url, values, more_headers=None, page_info=None):
+        response = await self.request_content_async(url, values, more_headers, page_info)
+        return codec.loads(response.read())
+
+    async def request_content_async(self, url, values, more_headers=None, page_info=None):
+        response = await self.transport.open(self.build_request(url, values, more_headers))
+        connect.fill_page_info(page_info, response)
+        return response
+
+
+class AsyncDownload(connect.Download):
+    """
+    Download with media requested as coroutines on the event loop
+    """
+    def __init__(self, parent=None):
+        connect.Download.__init__(self, parent)
+        self.loop_thread = get_event_loop_thread()
+        # TODO: find a better way for unsecure connection
+        self.transport = AsyncConnectionPool(context=ssl._create_unverified_context(), timeout=self.timeout,
+                                             max_per_host=self.max_parallel_downloads)
+        self.tasks = set()
+        # HostLimiter -> asyncio.Condition notified when a slot of the host is released
+        self.slot_conditions = {}
+
+    def cancel_tasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    @pyqtSlot(list)
+    def add_separately(self, words):
+        self.counter = 0
+        self.total_words = len(words)
+        self.retry_scheduler.reset()
+        self.broken_links = brokenlinks.BrokenLinks(utils.get_broken_links_path(), self.broken_links_ttl)
+        self.Busy.emit(True)
+        task = self.loop_thread.submit(self.download_words(words))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def download_words(self, words):
+        slots = asyncio.Semaphore(self.max_parallel_downloads)
+        await asyncio.gather(*[self.download_word(word, slots) for word in words])
+
+    async def download_word(self, word, slots):
+        failures = 0
+        while True:
+            try:
+                async with slots:
+                    await self.download_word_media(word)
+                break
+            except utils.KnownBrokenUrl:
+                self.skipped_words.append(word.get('wordValue'))
+                break
+            except (urllib.error.URLError, socket.error) as e:
+                if not retry.is_retryable_error(e):
+                    self.broken_words.append(word.get('wordValue'))
+                    break
+                failures += 1
+                delay = self.retry_scheduler.get_delay(failures)
+                if delay is None:
+                    self.problem_words.append(word.get('wordValue'))
+                    break
+                # The word waits without holding a slot, so other words are downloaded meanwhile
+                await asyncio.sleep(delay)
+        self.emit_word_and_counter(utils.prepare_note_fields(word))
+
+    async def download_word_media(self, word):
+        known_broken_url = None
+        for url in utils.get_media_urls(word):
+            if not utils.is_valid_ascii(url):
+                raise utils.InvalidMediaUrl('Invalid picture url: ' + url)
+            if self.broken_links.is_broken(url):
+                known_broken_url = url
+                continue
+            try:
+                await self.download_media_file(url)
+            except urllib.error.HTTPError as e:
+                if not retry.is_retryable_error(e):
+                    self.broken_links.add(url)
+                raise
+        if known_broken_url:
+            raise utils.KnownBrokenUrl('Broken media url: ' + known_broken_url)
+
+    async def download_media_file(self, url):
+        abs_path = utils.get_media_path(url)
+        if not abs_path:
+            return
+        # Fix '\n' symbols in the url (they were found in the long sentences)
+        url = url.replace('\n', '')
+        limiter = self.concurrency.get_limiter(url)
+        condition = self.slot_conditions.get(limiter)
+        if condition is None:
+            condition = self.slot_conditions[limiter] = asyncio.Condition()
+        async with condition:
+            await condition.wait_for(limiter.try_acquire)
+        # Uncompressed body is written to the file as it arrives
+        request = urllib.request.Request(url, headers={'Accept-Encoding': 'identity'})
+        try:
+            with self.concurrency.measure(limiter) as result:
+                media_file = utils.MediaFile(abs_path)
+                try:
+                    await self.transport.open(request, media_file.write)
+                    # Transport has already checked the length of the body it received
+                    result['size'] = media_file.commit()
+                except:
+                    media_file.discard()
+                    raise
+        finally:
+            async with condition:
+                # The limit could have changed with the released request, wake up as many as may start
+                condition.notify(max(1, limiter.limit - limiter.active))
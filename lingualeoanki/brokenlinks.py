@@ -0,0 +1,62 @@
+"""
+Persistent cache of media links that were found broken (e.g. 404) during previous imports.
+Such links are not requested again until their record expires,
+so re-imports don't wait for the requests that are going to fail anyway.
+"""
+import os
+import threading
+import time
+
+from . import codec
+
+
+class BrokenLinks(object):
+    """
+    Links are stored as json: {"<url>": <time when the link failed>}
+    """
+    def __init__(self, path, ttl):
+        """
+        :param path: path to the file or None not to keep the links between imports
+        :param ttl: seconds to remember a broken link
+        """
+        self.path = path
+        self.ttl = ttl
+        self.links = {}
+        self.is_changed = False
+        # Links are checked and added from the download workers
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                links = codec.loads(f.read())
+            now = time.time()
+            self.links = dict((url, failed) for url, failed in links.items() if now - failed < self.ttl)
+        except (IOError, ValueError, AttributeError, TypeError):
+            # Broken links are just requested again
+            self.links = {}
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.is_changed:
+                return
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(codec.dumps(self.links))
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+            self.is_changed = False
+
+    def is_broken(self, url):
+        with self.lock:
+            failed = self.links.get(url)
+            return failed is not None and time.time() - failed < self.ttl
+
+    def add(self, url):
+        with self.lock:
+            self.links[url] = time.time()
+            self.is_changed = True
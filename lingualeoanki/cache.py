@@ -0,0 +1,192 @@
+"""
+On-disk cache of LinguaLeo API responses.
+Responses are stored by endpoint and canonical request body,
+the least recently used ones are removed when the cache grows over its size limit.
+Cache-Control of the responses is honored: no-store responses are not kept,
+no-cache and max-age limit the time a response is used without asking the server.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from . import codec
+
+
+INDEX_FILE = 'index.json'
+
+
+class CacheEntry(object):
+    def __init__(self, body, meta):
+        self.body = body
+        self.meta = meta
+
+    def is_fresh(self, ttl):
+        """
+        :param ttl: number of seconds to use the response, unless the server allowed less
+        """
+        max_age = self.meta.get('max_age')
+        if max_age is not None:
+            ttl = min(ttl, max_age)
+        return time.time() - self.meta.get('stored', 0) < ttl
+
+    def get_validators(self):
+        """
+        :return: dict of headers for a conditional request
+        """
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+
+class ResponseCache(object):
+    def __init__(self, directory, max_bytes, ttl):
+        """
+        :param directory: folder to keep cached responses
+        :param max_bytes: total size of responses to keep
+        :param ttl: number of seconds a response is used without asking the server
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = {}
+        self.load_index()
+
+    @staticmethod
+    def get_key(account, url, values):
+        """
+        Same request always produces the same key regardless of the order of keys in values.
+        All values are part of the key, including perPage of GetWords: a page of another size
+        holds other words, and a page shorter than perPage is taken for the last one of the group
+        """
+        canonical = json.dumps([account, url, values], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :return: CacheEntry or None if there is no cached response
+        """
+        with self.lock:
+            meta = self.index.get(key)
+            if not meta:
+                return None
+            try:
+                with open(self.get_path(key), 'rb') as f:
+                    body = f.read()
+            except (IOError, OSError):
+                self.remove(key)
+                return None
+            meta['accessed'] = time.time()
+            return CacheEntry(body, dict(meta))
+
+    def put(self, key, body, headers):
+        """
+        :param body: bytes of the response
+        :param headers: response headers with optional validators (ETag, Last-Modified) and Cache-Control
+        """
+        with self.lock:
+            if 'no-store' in get_cache_directives(headers):
+                self.remove(key)
+                self.save_index()
+                return
+            try:
+                with open(self.get_path(key), 'wb') as f:
+                    f.write(body)
+            except (IOError, OSError):
+                return
+            now = time.time()
+            self.index[key] = {'size': len(body), 'stored': now, 'accessed': now, 'max_age': get_max_age(headers),
+                               'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+            self.evict()
+            self.save_index()
+
+    def refresh(self, key, headers):
+        """
+        Server confirmed that cached response is still valid (304 Not Modified)
+        """
+        with self.lock:
+            meta = self.index.get(key)
+            if not meta:
+                return
+            meta['stored'] = meta['accessed'] = time.time()
+            meta['max_age'] = get_max_age(headers)
+            meta['etag'] = headers.get('ETag') or meta.get('etag')
+            meta['last_modified'] = headers.get('Last-Modified') or meta.get('last_modified')
+            self.save_index()
+
+    def invalidate(self):
+        with self.lock:
+            for key in list(self.index):
+                self.remove(key)
+            self.save_index()
+
+    def evict(self):
+        """
+        Remove least recently used responses until the cache fits into max_bytes
+        """
+        total = sum(meta['size'] for meta in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['accessed']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]['size']
+            self.remove(key)
+
+    def remove(self, key):
+        self.index.pop(key, None)
+        try:
+            os.remove(self.get_path(key))
+        except (IOError, OSError):
+            pass
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load_index(self):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                return
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), 'rb') as f:
+                self.index = codec.loads(f.read())
+        except (IOError, OSError, ValueError):
+            self.index = {}
+
+    def save_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), 'wb') as f:
+                f.write(codec.dumps(self.index))
+        except (IOError, OSError):
+            pass
+
+
+def get_cache_directives(headers):
+    """
+    :return: dict of Cache-Control directives, e.g. {'max-age': '60', 'no-cache': None}
+    """
+    directives = {}
+    for directive in (headers.get('Cache-Control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def get_max_age(headers):
+    """
+    :return: number of seconds the server allows to use the response without revalidation
+             or None if it's not limited
+    """
+    directives = get_cache_directives(headers)
+    if 'no-cache' in directives:
+        return 0
+    try:
+        return int(directives.get('max-age'))
+    except (TypeError, ValueError):
+        return None
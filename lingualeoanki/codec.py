@@ -0,0 +1,54 @@
+"""
+JSON encoding and decoding for LinguaLeo API.
+Uses the fastest library found (orjson is bundled with recent Anki versions)
+and falls back to the standard json module.
+"""
+import json
+
+try:
+    import orjson
+
+    def _loads(data):
+        return orjson.loads(data)
+
+    def _dumps(obj):
+        return orjson.dumps(obj)
+
+    NAME = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        def _loads(data):
+            return ujson.loads(data)
+
+        def _dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+        NAME = 'ujson'
+    except ImportError:
+        def _loads(data):
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            return json.loads(data)
+
+        def _dumps(obj):
+            return json.dumps(obj).encode('utf-8')
+
+        NAME = 'json'
+
+
+def loads(data):
+    """
+    :param data: bytes or str with JSON
+    :return: decoded object
+    """
+    return _loads(data)
+
+
+def dumps(obj):
+    """
+    :param obj: object to encode
+    :return: bytes with JSON in utf-8
+    """
+    return _dumps(obj)
@@ -0,0 +1,165 @@
+"""
+Adaptive limits of simultaneous requests to each host.
+The limit grows while throughput doesn't degrade and goes down
+when the host starts failing or responding noticeably slower.
+LinguaLeo API and media hosts (CDN) have different initial and maximum limits.
+"""
+import contextlib
+import threading
+import time
+
+from .six.moves import urllib
+from . import retry
+
+
+API_HOSTS = ('api.lingualeo.com', 'lingualeo.com')
+# Limits are adjusted after this number of requests (or the current limit, if it's larger)
+WINDOW_REQUESTS = 8
+# Throughput has to drop by this part to count as degraded
+THROUGHPUT_CHANGE = 0.1
+# Average response time that many times longer than the best one is a latency spike
+LATENCY_SPIKE = 2.0
+
+
+def is_congestion_error(error):
+    """
+    Errors that mean that the host or the connection is overloaded (unlike e.g. a broken link)
+    """
+    return retry.is_retryable_error(error)
+
+
+class HostLimiter(object):
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = max(self.minimum, min(self.maximum, initial))
+        self.active = 0
+        self.condition = threading.Condition()
+        # Bytes per second during the last window
+        self.throughput = 0.0
+        self.best_latency = None
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_start = None
+        self.window_requests = 0
+        self.window_bytes = 0
+        self.window_seconds = 0.0
+        self.window_errors = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def try_acquire(self):
+        """
+        Non-blocking acquire for the event loop
+        :return: True if the request can be sent
+        """
+        with self.condition:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self, seconds, size, is_error=False):
+        """
+        :param seconds: response time
+        :param size: number of received bytes
+        :param is_error: request failed because of congestion, see is_congestion_error
+        """
+        with self.condition:
+            self.active -= 1
+            self.record(seconds, size, is_error)
+            self.condition.notify_all()
+
+    def record(self, seconds, size, is_error):
+        now = time.time()
+        if self.window_start is None:
+            self.window_start = now - seconds
+        self.window_requests += 1
+        self.window_bytes += size
+        self.window_seconds += seconds
+        self.window_errors += 1 if is_error else 0
+        if self.window_requests < max(WINDOW_REQUESTS, self.limit):
+            return
+        throughput = self.window_bytes / max(now - self.window_start, 0.001)
+        latency = self.window_seconds / self.window_requests
+        self.adjust(throughput, latency, self.window_errors)
+        self.reset_window()
+
+    def adjust(self, throughput, latency, errors):
+        previous = self.throughput
+        if errors:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self.best_latency and latency > self.best_latency * LATENCY_SPIKE:
+            self.limit = max(self.minimum, self.limit - 1)
+        elif previous and throughput < previous * (1 - THROUGHPUT_CHANGE):
+            self.limit = max(self.minimum, self.limit - 1)
+        else:
+            # Keep probing while more requests don't slow the host down
+            self.limit = min(self.maximum, self.limit + 1)
+        self.throughput = throughput
+        if not errors:
+            self.best_latency = min(self.best_latency or latency, latency)
+
+
+class ConcurrencyController(object):
+    def __init__(self, api_limits, media_limits):
+        """
+        :param api_limits: (initial, maximum) number of simultaneous requests to LinguaLeo API
+        :param media_limits: (initial, maximum) number of simultaneous requests to each media host
+        """
+        self.api_limits = api_limits
+        self.media_limits = media_limits
+        self.lock = threading.Lock()
+        self.limiters = {}
+
+    def get_limiter(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limits = self.api_limits if host in API_HOSTS else self.media_limits
+                limiter = self.limiters[host] = HostLimiter(*limits)
+            return limiter
+
+    @contextlib.contextmanager
+    def request(self, url):
+        """
+        Wait for a free slot of the url's host and measure the request
+        Usage:
+            with controller.request(url) as result:
+                result['size'] = <number of received bytes>
+        """
+        limiter = self.get_limiter(url)
+        limiter.acquire()
+        with self.measure(limiter) as result:
+            yield result
+
+    @contextlib.contextmanager
+    def measure(self, limiter):
+        """
+        Measure the request sent with already acquired limiter and release it
+        """
+        result = {'size': 0}
+        start = time.time()
+        is_error = False
+        try:
+            yield result
+        except Exception as e:
+            is_error = is_congestion_error(e)
+            raise
+        finally:
+            limiter.release(time.time() - start, result['size'], is_error)
+
+    def format_stats(self):
+        """
+        :return: str with current limits and throughput of the hosts
+        """
+        with self.lock:
+            limiters = sorted(self.limiters.items())
+        return ', '.join('{}: {} parallel, {:.0f} KB/s'.format(host, limiter.limit, limiter.throughput / 1024)
+                         for host, limiter in limiters)
@@ -1,13 +1,25 @@
 import os
 from .six.moves import http_cookiejar
 from .six.moves import urllib
+from .six.moves import queue
 import socket
 import json
 import ssl
 import base64
+import threading
+import time
 
 from aqt.qt import *
 from . import utils
+from . import transport
+from . import codec
+from . import pager
+from . import snapshot
+from . import cache
+from . import brokenlinks
+from . import concurrency
+from . import retry
+from . import wordlist
 
 
 class Lingualeo(QObject):
@@ -16,6 +28,8 @@ class Lingualeo(QObject):
     AuthorizationStatus = pyqtSignal(bool)
     Words = pyqtSignal(list)
     Wordsets = pyqtSignal(list)
+    WordsProgress = pyqtSignal(int, int)
+    ConnectionStats = pyqtSignal(str)
 
     def __init__(self, email, password, cookies_path=None, parent=None):
         QObject.__init__(self, parent)
@@ -35,12 +49,45 @@ class Lingualeo(QObject):
                 except:
                     # TODO: Handle corrupt cookies loading
                     self.cj = http_cookiejar.MozillaCookieJar()
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cj))
         config = utils.get_config()
         self.WORDS_PER_REQUEST = config['wordsPerRequest'] if config else 999
+        # Page size is adjusted to the response time, not exceeding WORDS_PER_REQUEST
+        self.pager = pager.AdaptivePager(utils.get_user_files_path('page_size.json'), self.WORDS_PER_REQUEST,
+                                         config.get('minWordsPerRequest', 100) if config else 100,
+                                         self.WORDS_PER_REQUEST,
+                                         config.get('targetPageSeconds', 3) if config else 3,
+                                         config.get('adaptivePageSize', True) if config else True)
+        self.ATTRIBUTE_PROFILE = config.get('attributeProfile', 'auto') if config else 'auto'
+        self.words_attributes = WORDS_ATTRIBUTE_LIST
+        # Treat different forms of the same word (e.g. 'go' and 'went') as one word when merging wordsets
+        self.MERGE_BY_LEMMA = config.get('mergeByLemma', False) if config else False
+        self.snapshot = snapshot.VocabularySnapshot(utils.get_snapshot_path(email))
+        cache_dir = utils.get_user_files_path('cache')
+        cache_size = config.get('cacheSizeMB', 50) if config else 50
+        self.cache = cache.ResponseCache(cache_dir, cache_size * 1024 * 1024,
+                                         config.get('cacheTTL', 900) if config else 900) \
+            if cache_dir and cache_size > 0 else None
+        self.only_new = False
+        # Number of simultaneous API requests (independent of parallel media downloads)
+        self.API_CONCURRENCY = max(1, config.get('apiConcurrency', 4)) if config else 4
+        # Number of simultaneous API requests goes down if LinguaLeo responds slower or with errors
+        self.concurrency = concurrency.ConcurrencyController((self.API_CONCURRENCY, self.API_CONCURRENCY),
+                                                             (self.API_CONCURRENCY, self.API_CONCURRENCY))
+        self.progress_lock = threading.Lock()
+        self.words_received = 0
+        self.words_total = 0
+        # Keep-alive connections to LinguaLeo hosts, shared by all API calls of this object
+        self.API_TIMEOUT = config.get('apiTimeout', 60) if config else 60
+        self.transport = transport.ConnectionPool(self.cj, timeout=self.API_TIMEOUT,
+                                                  max_idle_per_host=self.API_CONCURRENCY)
         self.url_prefix = 'https://'
         self.msg = ''
         self.tried_ssl_fix = False
+        # A successful API call within this number of seconds proves that session is still valid
+        self.SESSION_TTL = config.get('sessionTTL', 600) if config else 600
+        self.last_success = None
+        self.session_generation = 0
+        self.auth_lock = threading.Lock()
 
     @pyqtSlot()
     def authorize(self):
@@ -50,33 +97,17 @@ class Lingualeo(QObject):
 
     def get_connection(self):
         try:
+            if self.is_session_valid():
+                # No need to ask the server, if session has expired, API call will authorize again
+                return True
             if not self.is_authorized():
                 status = self.auth()
                 if status.get('error_msg'):
                     self.msg = status['error_msg']
-        except urllib.error.HTTPError:
-            self.msg = "We got HTTP Error. Probably API has been changed (again). " \
-                       "Please try again. If error persists, please copy the error message and create a new issue " \
-                       "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new)."
-        except (urllib.error.URLError, socket.error) as e:
-            # TODO: Find better (secure) fix
-            """
-            SSLError was noticed on MacOS, because Python 3.6m used in Anki doesn't have 
-            security certificates downloaded. The easiest (but unsecure) way is to create SSL context.
-            """
-            if 'SSL' in str(e.args) and not self.tried_ssl_fix:
-                # Problem with https connection, trying ssl fix
-                https_handler = urllib.request.HTTPSHandler(context=ssl._create_unverified_context())
-                self.opener = urllib.request.build_opener(https_handler, urllib.request.HTTPCookieProcessor(self.cj))
-                self.tried_ssl_fix = True
-                return self.get_connection()
-            else:
-                self.msg = "Can't authorize. Problems with internet connection. Error message: " + str(e.args)
-        except ValueError:
-            self.msg = "Error! Possibly, invalid data was received from LinguaLeo"
         except Exception as e:
-            self.msg = "There's been an unexpected error. Please copy the error message and create a new issue " \
-                       "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+            if is_connection_error(e) and self.try_ssl_fix(e):
+                return self.get_connection()
+            self.msg = get_connection_error_message(e)
         if self.msg:
             self.Error.emit(self.msg)
             self.msg = ''
@@ -89,48 +120,20 @@ class Lingualeo(QObject):
         Get user's dictionaries (wordsets), including default ones,
         and return ids and names of not empty ones
         """
-        # TODO: Unite exception proccessing for get_wordsets and get_words_to_add into one function (e.g. get_data),
-        #  it will make code cleaner and reduce errors
         self.Busy.emit(True)
         wordsets = []
         if not self.get_connection():
             self.Wordsets.emit(wordsets)
             self.Busy.emit(False)
             return
-        url = 'api.lingualeo.com/GetWordSets'
-        values = {'apiVersion': '1.0.0',
-                  'request': [{'subOp': 'myAll', 'type': 'user', 'perPage': 999,
-                               'attrList': WORDSETS_ATTRIBUTE_LIST, 'sortBy': 'created'}],
-                  'ctx': {'config': {'isCheckData': True, 'isLogging': True}}}
         try:
-            response = self.get_content(url, values)
-            if response.get('error') or not response.get('data'):
-                raise Exception('Incorrect data received from LinguaLeo. Possibly API was changed again. '
-                                + response.get('error').get('message'))
-            all_wordsets = response['data'][0]['items']
-            # Add only non-empty dictionaries
-            for wordset in all_wordsets:
-                count = wordset['countWordsLearned'] if status == 'learned' else wordset['countWords']
-                if count == 0:
-                    continue  # No need to show an empty dictionary in the list
-                # To avoid unicode string error on Python 2.7, it should be set in the following way
-                list_name = wordset['name'] + ' ({} {})'.format(count, 'words' if count > 1 else 'word')
-                if wordset['id'] == 1 and status != 'learned':  # Main dictionary with all words
-                    list_name = list_name[:-1] + ' in total)'
-                wordsets.append({'list_name': list_name, 'id': wordset['id']})
+            response = self.get_api_content(WORDSETS_URL, get_wordsets_request(), use_cache=True)
+            wordsets = parse_wordsets(response, status)
             self.save_cookies()
             if not wordsets:
                 self.msg = 'No user dictionaries found'
-        except (urllib.error.URLError, socket.error):
-            self.msg = "Can't get dictionaries. Problem with internet connection."
-        except ValueError:
-            self.msg = "Error! Possibly, invalid data was received from LinguaLeo."
-        except KeyError:
-            self.msg = "Can't get list of wordsets. Possibly API was changed again. Please create a new issue " \
-                       "on GitHub: https://github.com/vi3itor/lingualeoanki/issues/new"
         except Exception as e:
-            self.msg = "There's been an unexpected error. Please copy the error message and create a new issue " \
-                       "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+            self.msg = get_wordsets_error_message(e)
         if self.msg:
             self.Error.emit(self.msg)
             self.msg = ''
@@ -139,40 +142,39 @@ class Lingualeo(QObject):
         self.Wordsets.emit(wordsets)
         self.Busy.emit(False)
 
-    @pyqtSlot(str, list, bool)
-    def get_words_to_add(self, status, wordsets, with_context=False):
+    @pyqtSlot(str, list, bool, bool)
+    def get_words_to_add(self, status, wordsets, with_context=False, only_new=False):
+        """
+        :param only_new: request only words added since the last import and skip unchanged ones
+        """
         self.Busy.emit(True)
         words = []
         if not self.get_connection():
             self.Words.emit(words)
             self.Busy.emit(False)
             return
+        self.start_words_request(wordsets, only_new)
         try:
             get_func = self.get_words_with_context if with_context else self.get_words
             wordset_ids = wordsets if wordsets else [1]
-            for wordset_id in wordset_ids:
-                received_words = get_func(status, wordset_id)
-                # print(get_func.__name__ + ' ' + str(len(received_words)) + ' words received')
-                words = get_unique_words(received_words, words)
+            # Wordsets are requested simultaneously, but merged in the order they were chosen
+            all_received = run_in_parallel(lambda wordset_id: get_func(status, wordset_id),
+                                           wordset_ids, self.API_CONCURRENCY)
+            words = wordlist.get_unique_words(all_received, self.MERGE_BY_LEMMA)
             # print(str(len(words)) + ' unique words')
             # TODO: Notify user if len(unique_words) is less than a number of words in the main wordset
 
             self.save_cookies()
-        except (urllib.error.URLError, socket.error):
-            self.msg = "Can't download words. Problem with internet connection."
-        except ValueError:
-            self.msg = "Error! Possibly, invalid data was received from LinguaLeo"
-        except KeyError:
-            self.msg = "Can't get list of words. Possibly API was changed again. Please create a new issue " \
-                       "on GitHub: https://github.com/vi3itor/lingualeoanki/issues/new"
+            self.pager.save()
+            self.ConnectionStats.emit(self.transport.format_stats())
         except Exception as e:
-            self.msg = "There's been an unexpected error. Please copy the error message and create a new issue " \
-                       "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+            self.msg = get_words_error_message(e)
         if self.msg:
             self.Error.emit(self.msg)
             self.msg = ''
             # TODO: Check if it is handled correctly (avoid double Info window)
             words = []
+            self.snapshot.discard()
 
         self.Words.emit(words)
         self.Busy.emit(False)
@@ -184,60 +186,143 @@ class Lingualeo(QObject):
         Each word group has:
         groupCount - number of words in the group,
         groupName - name of the group, like 'new' or 'year_2' (stands for 2 years ago),
-        words - list of words (not more than self.WORDS_PER_REQUEST)
+        words - list of words (not more than perPage of the request, see self.pager)
+        The first request (dateGroup 'start') returns names and sizes of all groups,
+        then every group is requested independently from the others.
         :param status: progress status of the word: 'all', 'new', 'learning', 'learned'
         :param wordset_id: an id of the wordset (1 - for main dictionary with all words)
         :return: list of words, where each word is a dict
         """
-        url = 'api.lingualeo.com/GetWords'
-        date_group = 'start'
-        offset = {}
-        values = {"apiVersion": "1.0.1", "attrList": WORDS_ATTRIBUTE_LIST,
-                  "category": "", "dateGroup": date_group, "mode": "basic", "perPage": self.WORDS_PER_REQUEST,
-                  "status": status, "offset": offset, "search": "", "training": None, "wordSetId": wordset_id,
-                  "ctx": {"config": {"isCheckData": True, "isLogging": True}}}
+        values = self.get_words_request(status, wordset_id)
+        date_groups = get_date_groups(self.get_word_groups(values))
+        self.add_date_groups_progress(date_groups)
 
+        key = snapshot.get_key(wordset_id, status)
+        if self.only_new and is_ordered_by_creation(status, wordset_id):
+            words = self.get_new_words(values, date_groups, key)
+            return self.snapshot.stage_words(key, words)
+        groups_words = run_in_parallel(lambda date_group: self.get_date_group_words(values, *date_group),
+                                       date_groups, self.API_CONCURRENCY)
+        words = [word for words in groups_words for word in words]
+        changed_words = self.snapshot.stage_words(key, words)
+        return changed_words if self.only_new else words
+
+    def get_new_words(self, values, date_groups, key):
+        """
+        Request date groups one by one, from the newest to the oldest,
+        and stop as soon as the words that were imported before are reached
+        :param values: request values used for the first request
+        :param date_groups: list of (name, count, received words) tuples
+        :param key: key of the wordset in the snapshot
+        :return: list of words
+        """
         words = []
-        words_received = 0
-        extra_date_group = date_group  # to get into the while loop
-
-        # TODO: Refactor while loop (e.g. request words from each group until it is not empty)
-        # Request the words until
-        while words_received > 0 or extra_date_group:
-            if words_received == 0 and extra_date_group:
-                values['dateGroup'] = extra_date_group
-                extra_date_group = None
-            else:
-                values['dateGroup'] = date_group
-                values['offset'] = offset
-            response = self.get_content(url, values)
-            word_groups = response.get('data')
-            if response.get('error'):
-                raise Exception('Incorrect data received from LinguaLeo. Possibly API has been changed again. '
-                                + response.get('error'))
-            words_received = 0
-            for word_group in word_groups:
-                word_chunk = word_group.get('words')
-                if word_chunk:
-                    words += word_chunk
-                    words_received += len(word_chunk)
-                    date_group = word_group.get('groupName')
-                    offset['wordId'] = word_group.get('words')[-1].get('id')
-                elif words_received > 0:
-                    ''' 
-                    If the next word_chunk is empty, and we completed the previous, 
-                    next response should be to the next group
-                    '''
-                    if words_received < self.WORDS_PER_REQUEST:
-                        date_group = word_group.get('groupName')
-                        extra_date_group = None
-                        offset = {}
-                    else:  # words_received == self.WORDS_PER_REQUEST
-                        '''We either need to continue with this group or try the next'''
-                        extra_date_group = word_group.get('groupName')
-                    break
+        for date_group, group_count, group_words in date_groups:
+            if not self.snapshot.is_known_territory(key, group_words):
+                group_words = self.get_date_group_words(values, date_group, group_count, group_words,
+                                                        lambda chunk: self.snapshot.is_known_territory(key, chunk))
+            words += group_words
+            if self.snapshot.is_known_territory(key, group_words):
+                break
         return words
 
+    def get_date_group_words(self, values, date_group, group_count, words, stop_at=None):
+        """
+        Request the rest of the words of one date group
+        :param values: request values used for the first request
+        :param date_group: name of the group, e.g. 'new' or 'year_2'
+        :param group_count: number of words in the group (None if unknown)
+        :param words: words of the group that were already received
+        :param stop_at: function that checks received page and returns True to stop requesting
+        :return: list of all words of the group
+        """
+        words = list(words)
+        while group_count is None or len(words) < group_count:
+            page_values = get_page_request(values, date_group, words, self.pager.get_size())
+            word_chunk = get_group_words(self.get_word_groups(page_values), date_group)
+            if not word_chunk:
+                break
+            words += word_chunk
+            self.add_words_progress(len(word_chunk), 0)
+            # perPage might have been reduced while the page was requested
+            if len(word_chunk) < page_values['perPage'] or (stop_at and stop_at(word_chunk)):
+                break
+        return words
+
+    def get_word_groups(self, values):
+        # Looking for new words makes no sense with cached pages
+        response = self.get_words_page(values, use_cache=not self.only_new)
+        return parse_word_groups(response)
+
+    def get_words_page(self, values, use_cache=False):
+        """
+        Request a page of words and adjust the size of the next pages to its response time.
+        If the page times out, it is requested again with a smaller size (values['perPage'] is updated).
+        :return: response content
+        """
+        page_info = {}
+        try:
+            content = self.get_api_content(WORDS_URL, values, use_cache, page_info)
+        except socket.timeout:
+            if not self.reduce_page_size(values):
+                raise
+            return self.get_words_page(values, use_cache)
+        self.record_page(values, content, page_info)
+        return content
+
+    def reduce_page_size(self, values):
+        """
+        :return: True if the page can be requested again with a smaller size
+        """
+        self.pager.record_timeout()
+        if self.pager.get_size() >= values['perPage']:
+            return False
+        values['perPage'] = self.pager.get_size()
+        return True
+
+    def record_page(self, values, content, page_info):
+        """
+        Pass the response time of a page to the pager (only for pages actually received from the server)
+        """
+        if page_info.get('elapsed') is None:
+            return
+        self.pager.record(values['perPage'], count_page_words(content), page_info['elapsed'], page_info.get('size'))
+
+    def start_words_request(self, wordsets, only_new):
+        """
+        Reset the state shared by all requests for the chosen wordsets
+        """
+        self.words_received = 0
+        self.words_total = 0
+        self.words_attributes = get_words_attributes(self.ATTRIBUTE_PROFILE, self.MERGE_BY_LEMMA)
+        self.only_new = only_new
+        self.snapshot.discard()
+
+    def get_words_request(self, status, wordset_id):
+        """
+        :return: values of the first request for words of the new API
+        """
+        return {"apiVersion": "1.0.1", "attrList": self.words_attributes,
+                "category": "", "dateGroup": 'start', "mode": "basic", "perPage": self.pager.get_size(),
+                "status": status, "offset": {}, "search": "", "training": None, "wordSetId": wordset_id,
+                "ctx": {"config": {"isCheckData": True, "isLogging": True}}}
+
+    def add_date_groups_progress(self, date_groups):
+        # When only new words are requested, the total number is unknown
+        self.add_words_progress(sum(len(words) for _, _, words in date_groups),
+                                sum(count or 0 for _, count, _ in date_groups) if not self.only_new else 0)
+
+    def add_words_progress(self, received, total):
+        """
+        Accumulate the number of received words and the number of expected words
+        for all wordsets requested at once and notify the progress bar
+        """
+        with self.progress_lock:
+            self.words_received += received
+            self.words_total += total
+            progress = (self.words_received, self.words_total)
+        self.WordsProgress.emit(*progress)
+
     def get_words_with_context(self, status, wordset_id):
         """
         This temporary function is to support old API until LinguaLeo fixes all issues with new API:
@@ -248,21 +333,43 @@ class Lingualeo(QObject):
         :return: list of words, where each word is a dict
         """
         # TODO: Unite get_words and get_words_old_api functions into one
-        url = 'api.lingualeo.com/GetWords'
-        values = {"apiVersion": "1.0.0", "attrList": WORDS_ATTRIBUTE_LIST,
-                  "category": "", "mode": "basic", "perPage": self.WORDS_PER_REQUEST, "status": status,
-                  "wordSetIds": [wordset_id], "offset": None, "search": "", "training": None,
-                  "ctx": {"config": {"isCheckData": True, "isLogging": True}}}
+        values = self.get_context_words_request(status, wordset_id)
 
         words = []
-        next_chunk = self.get_content(url, values).get('data')
+        next_chunk = self.get_words_page(values).get('data')
         # Continue getting the words until list is not empty
         while next_chunk:
             words += next_chunk
             values['offset'] = {'wordId': next_chunk[-1].get('id')}
-            next_chunk = self.get_content(url, values).get('data')
+            values['perPage'] = self.pager.get_size()
+            next_chunk = self.get_words_page(values).get('data')
 
-        return words
+        return self.stage_context_words(status, wordset_id, words)
+
+    def get_context_words_request(self, status, wordset_id):
+        """
+        :return: values of the first request for words of the old API
+        """
+        return {"apiVersion": "1.0.0", "attrList": self.words_attributes,
+                "category": "", "mode": "basic", "perPage": self.pager.get_size(), "status": status,
+                "wordSetIds": [wordset_id], "offset": None, "search": "", "training": None,
+                "ctx": {"config": {"isCheckData": True, "isLogging": True}}}
+
+    def stage_context_words(self, status, wordset_id, words):
+        # Old API doesn't group the words by date, so all of them are requested
+        changed_words = self.snapshot.stage_words(snapshot.get_key(wordset_id, status), words)
+        return changed_words if self.only_new else words
+
+    @pyqtSlot()
+    def commit_snapshot(self):
+        """
+        Remember the words of the last request as imported
+        """
+        try:
+            self.snapshot.commit()
+        except (IOError, OSError):
+            # Without a snapshot next import just requests all words again
+            pass
 
     def save_cookies(self):
         if hasattr(self, 'cookies_path'):
@@ -272,6 +379,16 @@ class Lingualeo(QObject):
     #########################
 
     def auth(self):
+        content = self.get_content(*self.get_auth_request())
+        # TODO: If user enters incorrect email, LinguaLeo will create a new account!
+        #  I hope they will fix it soon, otherwise we need to notify user
+        self.process_auth(content)
+        return content
+
+    def get_auth_request(self):
+        """
+        :return: url, values and extra headers of authorization request
+        """
         url = 'lingualeo.com/auth'
         values = {
             "type": "mixed",
@@ -279,30 +396,165 @@ class Lingualeo(QObject):
         }
         # Without this header request gets Error 405: Not Allowed
         extra_headers = {'Referer': 'https://lingualeo.com/ru/'}
-        content = self.get_content(url, values, extra_headers)
-        # TODO: If user enters incorrect email, LinguaLeo will create a new account!
-        #  I hope they will fix it soon, otherwise we need to notify user
+        return url, values, extra_headers
+
+    def process_auth(self, content):
         self.save_cookies()
-        return content
+        if not content.get('error_msg'):
+            self.mark_session_valid()
 
     def is_authorized(self):
-        url = 'api.lingualeo.com/isauthorized'
-        full_url = self.url_prefix + url
-        response = self.opener.open(full_url)
-        status = json.loads(response.read()).get('is_authorized')
+        response = self.transport.open(self.url_prefix + ISAUTHORIZED_URL)
+        return self.process_is_authorized(response)
+
+    def process_is_authorized(self, response):
+        status = codec.loads(response.read()).get('is_authorized')
+        if status:
+            self.mark_session_valid()
         return status
 
-    def get_content(self, url, values, more_headers=None):
+    def is_session_valid(self):
+        """
+        Check without a request to the server if the session can be trusted:
+        either there was a successful API call recently or the saved cookies haven't expired yet
+        """
+        now = time.time()
+        if self.last_success and now - self.last_success < self.SESSION_TTL:
+            return True
+        cookies = [cookie for cookie in self.cj if 'lingualeo' in cookie.domain]
+        return bool(cookies) and all(cookie.expires and not cookie.is_expired(now) for cookie in cookies)
+
+    def mark_session_valid(self):
+        self.last_success = time.time()
+
+    def invalidate_session(self):
+        self.last_success = None
+        self.cj.clear()
+
+    def try_ssl_fix(self, e):
+        """
+        SSLError was noticed on MacOS, because Python 3.6m used in Anki doesn't have
+        security certificates downloaded. The easiest (but unsecure) way is to create SSL context.
+        :return: True if the request should be repeated
+        """
+        # TODO: Find better (secure) fix
+        if 'SSL' in str(e.args) and not self.tried_ssl_fix:
+            # Problem with https connection, trying ssl fix
+            self.transport.set_context(ssl._create_unverified_context())
+            self.tried_ssl_fix = True
+            return True
+        return False
+
+    def get_api_content(self, url, values, use_cache=False, page_info=None):
+        """
+        Request API content trusting the cached session.
+        If LinguaLeo rejects the session, authorize again and repeat the request once.
+        :param use_cache: take the response from the on-disk cache if possible
+        :param page_info: dict to fill with response time and size, see request_content
+        """
+        if use_cache and self.cache:
+            # Fresh cached response says nothing about the session
+            content = self.get_fresh_cached_content(url, values)
+            if content is not None:
+                return content
+        get_func = self.get_cached_content if use_cache and self.cache else self.get_content
+        generation = self.session_generation
+        try:
+            content = get_func(url, values, page_info=page_info)
+            is_rejected = is_authorization_error(content.get('error'))
+        except urllib.error.HTTPError as e:
+            if e.code not in (401, 403):
+                raise
+            is_rejected = True
+        except (urllib.error.URLError, socket.error) as e:
+            if not self.try_ssl_fix(e):
+                raise
+            return self.get_api_content(url, values, use_cache, page_info)
+        if not is_rejected:
+            self.mark_session_valid()
+            return content
+        self.reauthorize(generation)
+        return get_func(url, values, page_info=page_info)
+
+    def get_fresh_cached_content(self, url, values):
+        """
+        :return: cached response that can be used without a request to the server (only for TTL_CACHED_URLS)
+                 or None
+        """
+        if url not in TTL_CACHED_URLS:
+            return None
+        entry = self.cache.get(self.cache.get_key(self.email, url, values))
+        if entry and entry.is_fresh(self.cache.ttl):
+            return codec.loads(entry.body)
+        return None
+
+    def get_cached_content(self, url, values, page_info=None):
+        """
+        Make a conditional request with validators of the cached response
+        and return the cached response if it wasn't modified
+        """
+        key = self.cache.get_key(self.email, url, values)
+        entry = self.cache.get(key)
+        response = self.request_content(url, values, entry.get_validators() if entry else None, page_info)
+        if response.status == 304 and entry:
+            self.cache.refresh(key, response.headers)
+            return codec.loads(entry.body)
+        content = codec.loads(response.read())
+        # Don't keep errors, e.g. when session has expired
+        if not content.get('error'):
+            self.cache.put(key, response.read(), response.headers)
+        return content
+
+    @pyqtSlot()
+    def invalidate_cache(self):
+        if self.cache:
+            self.cache.invalidate()
+
+    def reauthorize(self, generation):
+        """
+        Authorize again, unless another thread has already done it
+        after the request of the given session generation was sent
+        """
+        with self.auth_lock:
+            if generation != self.session_generation:
+                return
+            self.invalidate_session()
+            status = self.auth()
+            if status.get('error_msg'):
+                raise Exception(status['error_msg'])
+            self.session_generation += 1
+
+    def get_content(self, url, values, more_headers=None, page_info=None):
         """
         A method to request content using new API
         :param url:
         :param values: json
         :param more_headers: dic
+        :param page_info: dict
         :return: json
         """
+        response = self.request_content(url, values, more_headers, page_info)
+        return codec.loads(response.read())
+
+    def request_content(self, url, values, more_headers=None, page_info=None):
+        """
+        Send the request and return the response itself
+        :param page_info: dict to fill with 'elapsed' seconds and received 'size' of the response
+        :return: transport.Response
+        """
+        req = self.build_request(url, values, more_headers)
+        with self.concurrency.request(req.get_full_url()) as result:
+            response = self.transport.open(req)
+            result['size'] = response.raw_size
+        fill_page_info(page_info, response)
+        return response
+
+    def build_request(self, url, values, more_headers=None):
+        """
+        :return: urllib.request.Request
+        """
         full_url = self.url_prefix + url
-        data = json.dumps(values)
-        data = data.encode("utf-8")
+        data = codec.dumps(values)
 
         headers = {'Content-Type': 'application/json'}
         if more_headers:
@@ -310,9 +562,7 @@ class Lingualeo(QObject):
         # We have to create a request object, because urllibopener won't change default headers
         req = urllib.request.Request(full_url, data, headers)
         req.add_header('User-Agent', 'Anki Add-on')
-
-        response = self.opener.open(req)
-        return json.loads(response.read())
+        return req
 
     """
     Using requests module (only in Anki 2.1) it can be performed as:
@@ -328,30 +578,237 @@ class Lingualeo(QObject):
     #  see: http://docs.python-requests.org/en/master/user/quickstart/#response-status-codes
 
 
-def get_unique_words(more_words, already_unique_words):
+def is_connection_error(e):
+    return isinstance(e, (urllib.error.URLError, socket.error)) and not isinstance(e, urllib.error.HTTPError)
+
+
+def get_connection_error_message(e):
+    """
+    :param e: exception raised while authorizing
+    :return: str with a message for user
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        return "We got HTTP Error. Probably API has been changed (again). " \
+               "Please try again. If error persists, please copy the error message and create a new issue " \
+               "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new)."
+    if is_connection_error(e):
+        return "Can't authorize. Problems with internet connection. Error message: " + str(e.args)
+    if isinstance(e, ValueError):
+        return "Error! Possibly, invalid data was received from LinguaLeo"
+    return "There's been an unexpected error. Please copy the error message and create a new issue " \
+           "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+
+
+def get_wordsets_error_message(e):
+    """
+    :param e: exception raised while requesting wordsets
+    :return: str with a message for user
+    """
+    if isinstance(e, (urllib.error.URLError, socket.error)):
+        return "Can't get dictionaries. Problem with internet connection."
+    if isinstance(e, ValueError):
+        return "Error! Possibly, invalid data was received from LinguaLeo."
+    if isinstance(e, KeyError):
+        return "Can't get list of wordsets. Possibly API was changed again. Please create a new issue " \
+               "on GitHub: https://github.com/vi3itor/lingualeoanki/issues/new"
+    return "There's been an unexpected error. Please copy the error message and create a new issue " \
+           "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+
+
+def get_words_error_message(e):
+    """
+    :param e: exception raised while requesting words
+    :return: str with a message for user
+    """
+    if isinstance(e, (urllib.error.URLError, socket.error)):
+        return "Can't download words. Problem with internet connection."
+    if isinstance(e, ValueError):
+        return "Error! Possibly, invalid data was received from LinguaLeo"
+    if isinstance(e, KeyError):
+        return "Can't get list of words. Possibly API was changed again. Please create a new issue " \
+               "on GitHub: https://github.com/vi3itor/lingualeoanki/issues/new"
+    return "There's been an unexpected error. Please copy the error message and create a new issue " \
+           "on GitHub (https://github.com/vi3itor/lingualeoanki/issues/new). Error: " + str(e.args)
+
+
+def get_wordsets_request():
+    return {'apiVersion': '1.0.0',
+            'request': [{'subOp': 'myAll', 'type': 'user', 'perPage': 999,
+                         'attrList': WORDSETS_ATTRIBUTE_LIST, 'sortBy': 'created'}],
+            'ctx': {'config': {'isCheckData': True, 'isLogging': True}}}
+
+
+def parse_wordsets(response, status):
+    """
+    :param response: response to GetWordSets request
+    :param status: progress status of the words: 'all', 'new', 'learning', 'learned'
+    :return: list of ids and names of not empty wordsets
+    """
+    if response.get('error') or not response.get('data'):
+        raise Exception('Incorrect data received from LinguaLeo. Possibly API was changed again. '
+                        + response.get('error').get('message'))
+    wordsets = []
+    all_wordsets = response['data'][0]['items']
+    # Add only non-empty dictionaries
+    for wordset in all_wordsets:
+        count = wordset['countWordsLearned'] if status == 'learned' else wordset['countWords']
+        if count == 0:
+            continue  # No need to show an empty dictionary in the list
+        # To avoid unicode string error on Python 2.7, it should be set in the following way
+        list_name = wordset['name'] + ' ({} {})'.format(count, 'words' if count > 1 else 'word')
+        if wordset['id'] == 1 and status != 'learned':  # Main dictionary with all words
+            list_name = list_name[:-1] + ' in total)'
+        wordsets.append({'list_name': list_name, 'id': wordset['id']})
+    return wordsets
+
+
+def parse_word_groups(response):
+    """
+    :param response: response to GetWords request of the new API
+    :return: list of word groups
+    """
+    if response.get('error'):
+        raise Exception('Incorrect data received from LinguaLeo. Possibly API has been changed again. '
+                        + str(response.get('error')))
+    return response.get('data') or []
+
+
+def get_date_groups(word_groups):
+    """
+    :param word_groups: word groups of the first response
+    :return: list of (name, count, received words) tuples
+    """
+    date_groups = []
+    for word_group in word_groups:
+        words = word_group.get('words') or []
+        date_groups.append((word_group.get('groupName'), word_group.get('groupCount'), words))
+    return date_groups
+
+
+def is_ordered_by_creation(status, wordset_id):
+    """
+    Words join the subset in the order they were added to the vocabulary only for all words of the main dictionary.
+    An old word can be learned or added to a dictionary today, so in other subsets it appears behind
+    the words that were already imported, and the subset has to be requested completely to find it.
+    """
+    return status == 'all' and str(wordset_id) == '1'
+
+
+def get_page_request(values, date_group, words, per_page):
+    """
+    :param values: values of the first request
+    :param date_group: name of the group to request
+    :param words: words of the group that were already received
+    :param per_page: number of words to request
+    :return: values to request the next page of the group
+    """
+    page_values = dict(values)
+    page_values['dateGroup'] = date_group
+    page_values['perPage'] = per_page
+    page_values['offset'] = {'wordId': words[-1].get('id')} if words else {}
+    return page_values
+
+
+def count_page_words(content):
+    """
+    :param content: response to GetWords request of either API
+    :return: number of words in the response
+    """
+    data = content.get('data') or []
+    return sum(len(item.get('words') or []) if 'words' in item else 1 for item in data)
+
+
+def fill_page_info(page_info, response):
+    """
+    Not Modified response says nothing about the time to receive a page
+    """
+    if page_info is not None and response.status != 304:
+        page_info['elapsed'] = response.elapsed
+        page_info['size'] = response.raw_size
+
+
+def get_group_words(word_groups, date_group):
     """
-    Until LinguaLeo team fixes problems with their API,
-    we have to manually filter out repeating words
+    Response may also contain words of the next groups, they are requested separately
+    :return: words of the date_group or None
     """
-    for word_to_check in more_words:
-        if is_word_unique(word_to_check, already_unique_words):
-            already_unique_words.append(word_to_check)
-    return already_unique_words
+    for word_group in word_groups:
+        if word_group.get('groupName') == date_group:
+            return word_group.get('words')
+    return None
 
 
-def is_word_unique(check_word, words):
+def is_authorization_error(error):
     """
-    Helper function to test if a check_word doesn't appear in the list of words.
-    Used for filtering out repeating words while downloading from multiple wordsets.
-    :param check_word: dict
-    :param words: list of dict
+    Check if an error returned by API means that user is not authorized.
+    Only the status code of the error is trusted: the message may mention e.g. the author of a word
+    :param error: error from the response (dict, str or None)
     :return: bool
     """
-    # TODO: Improve algorithm for finding unique words
-    for word in words:
-        if word['id'] == check_word['id']:
-            return False
-    return True
+    if not isinstance(error, dict):
+        return False
+    code = error.get('code', error.get('status'))
+    try:
+        return int(code) in AUTHORIZATION_ERROR_CODES
+    except (TypeError, ValueError):
+        return False
+
+
+def get_words_attributes(profile, with_lemma=False):
+    """
+    Choose the list of word attributes to request from LinguaLeo.
+    With 'auto' profile only the attributes needed to fill the notes are requested.
+    TODO: Request wordsets of the words ('wordsets' profile) when notes are tagged by them
+    :param profile: 'auto' or one of the keys of WORDS_ATTRIBUTE_PROFILES
+    :param with_lemma: request wordLemmaId to merge the words by it
+    :return: dict of attributes
+    """
+    if profile == 'auto':
+        profile = 'minimal'
+    profiles = LEMMA_WORDS_ATTRIBUTE_PROFILES if with_lemma else WORDS_ATTRIBUTE_PROFILES
+    return profiles.get(profile, WORDS_ATTRIBUTE_LIST)
+
+
+def run_in_parallel(func, items, max_workers):
+    """
+    Calls func for each item using not more than max_workers threads.
+    If any call fails, the rest of the items are not processed
+    and the exception of the first failed item is raised.
+    :param func: function of one argument
+    :param items: list of arguments
+    :param max_workers: int
+    :return: list of results in the same order as items
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    tasks = queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def work():
+        while not any(errors):
+            try:
+                index, item = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                errors[index] = e
+
+    threads = [threading.Thread(target=work) for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
 
 
 class Download(QObject):
@@ -360,19 +817,34 @@ class Download(QObject):
     FinalCounter = pyqtSignal(int)
     Word = pyqtSignal(dict)
     Message = pyqtSignal(str)
+    MediaEstimate = pyqtSignal(int, int)
+    Stats = pyqtSignal(str)
 
     def __init__(self, parent=None):
         QObject.__init__(self, parent)
         config = utils.get_config()
         self.timeout = config['downloadTimeout']
-        self.retries = config['numberOfRetries']
-        self.sleep_seconds = config['sleepSeconds']
+        # Failed words are downloaded again later, see retry_word
+        self.retry_scheduler = retry.RetryScheduler(config['numberOfRetries'], config['sleepSeconds'],
+                                                    config.get('maxRetryDelay', 60),
+                                                    config.get('retryTimeLimit', 300))
+        self.failures = {}
+        self.broken_links_ttl = config.get('brokenLinksTTLDays', 30) * 24 * 60 * 60
+        self.broken_links = None
         self.threadpool = QThreadPool(self)
-        MAX_PARALLEL_DOWNLOADS = 3
-        max_threads = config['parallelDownloads']
-        parallel_downloads = max_threads if max_threads <= MAX_PARALLEL_DOWNLOADS else MAX_PARALLEL_DOWNLOADS
-        self.threadpool.setMaxThreadCount(parallel_downloads)
+        # Downloads start with parallelDownloads per host and adapt up to maxParallelDownloads
+        self.parallel_downloads = max(1, config['parallelDownloads'])
+        self.max_parallel_downloads = max(self.parallel_downloads, config.get('maxParallelDownloads', 12))
+        api_concurrency = max(1, config.get('apiConcurrency', 4))
+        self.concurrency = concurrency.ConcurrencyController(
+            (api_concurrency, api_concurrency), (self.parallel_downloads, self.max_parallel_downloads))
+        self.threadpool.setMaxThreadCount(self.max_parallel_downloads)
+        self.last_stats = 0
+        # Words with media that can't be downloaded now and with broken media links
         self.problem_words = []
+        self.broken_words = []
+        # Words with media links that were broken during previous imports
+        self.skipped_words = []
         self.counter = 0
         self.total_words = 0
 
@@ -386,14 +858,54 @@ class Download(QObject):
         """
         self.counter = 0
         self.total_words = len(words)
+        self.failures = {}
+        self.retry_scheduler.reset()
+        # Loaded for every import, because the user can ask to forget the links between imports
+        self.broken_links = brokenlinks.BrokenLinks(utils.get_broken_links_path(), self.broken_links_ttl)
         self.Busy.emit(True)
 
         for word in words:
-            download_worker = DownloadWorker(word, self.timeout, self.retries, self.sleep_seconds)
-            download_worker.signals.Word.connect(self.emit_word_and_counter)
-            download_worker.signals.ProblemWord.connect(self.problem_words.append)
-            # print('Adding worker for ' + word['wordValue'])
-            self.threadpool.start(download_worker)
+            self.start_worker(word)
+
+    def start_worker(self, word):
+        download_worker = DownloadWorker(word, self.timeout, self.concurrency, self.broken_links)
+        download_worker.signals.Word.connect(self.emit_word_and_counter)
+        download_worker.signals.BrokenWord.connect(self.broken_words.append)
+        download_worker.signals.SkippedWord.connect(self.skipped_words.append)
+        download_worker.signals.Failed.connect(self.retry_word)
+        # print('Adding worker for ' + word['wordValue'])
+        self.threadpool.start(download_worker)
+
+    @pyqtSlot(dict)
+    def retry_word(self, word):
+        """
+        Start downloading media of the word again after a delay.
+        Workers don't wait themselves, so they download other words meanwhile.
+        """
+        failures = self.failures.get(word.get('id'), 0) + 1
+        self.failures[word.get('id')] = failures
+        delay = self.retry_scheduler.get_delay(failures)
+        if delay is None:
+            # print("Problem with " + word['wordValue'])
+            self.problem_words.append(word.get('wordValue'))
+            self.emit_word_and_counter(utils.prepare_note_fields(word))
+            return
+        # print('Retry ' + word['wordValue'] + ' in ' + str(delay))
+        QTimer.singleShot(int(delay * 1000), lambda: self.start_worker(word))
+
+    @pyqtSlot(list)
+    def estimate_media(self, words):
+        """
+        Count media files that aren't in the collection yet and estimate their size
+        without downloading them. Emits the number of files and their size in kilobytes.
+        """
+        self.Busy.emit(True)
+        broken_links = brokenlinks.BrokenLinks(utils.get_broken_links_path(), self.broken_links_ttl)
+        urls = [url for word in words for url in utils.get_media_urls(word)
+                if utils.is_valid_ascii(url) and not broken_links.is_broken(url) and utils.get_media_path(url)]
+        size = utils.estimate_media_size(urls, self.timeout)
+        self.MediaEstimate.emit(len(urls), size // 1024)
+        self.Busy.emit(False)
 
     @pyqtSlot(dict)
     def emit_word_and_counter(self, word):
@@ -401,21 +913,49 @@ class Download(QObject):
         self.counter += 1
         # print("Counter " + str(self.counter))
         self.Counter.emit(self.counter)
+        self.emit_stats()
         if self.counter == self.total_words:
-            if self.problem_words:
+            self.save_broken_links()
+            if self.problem_words or self.broken_words or self.skipped_words:
                 self.emit_problem_words_msg()
             self.FinalCounter.emit(self.counter)
             self.Busy.emit(False)
 
+    def emit_stats(self):
+        """
+        Show current limits and throughput not more often than once a second
+        """
+        if time.time() - self.last_stats < 1:
+            return
+        self.last_stats = time.time()
+        self.Stats.emit(self.concurrency.format_stats())
+
     def emit_problem_words_msg(self):
-        error_msg = ("We weren't able to download media for these "
-                     "words because of broken links in LinguaLeo "
-                     "or problems with an internet connection: ")
-        for problem_word in self.problem_words[:-1]:
-            error_msg += problem_word + ', '
-        error_msg += self.problem_words[-1] + '.'
-        self.Message.emit(error_msg)
+        messages = []
+        if self.problem_words:
+            messages.append("We weren't able to download media for these words "
+                            "because of problems with an internet connection "
+                            "or LinguaLeo servers: " + ', '.join(self.problem_words) + '.')
+        if self.broken_words:
+            messages.append("Media for these words wasn't downloaded "
+                            "because of broken links in LinguaLeo: " + ', '.join(self.broken_words) + '.')
+        if self.skipped_words:
+            messages.append("Media for {} words wasn't downloaded because their links were broken "
+                            "during previous imports. Check 'Re-check broken links' "
+                            "to try them again.".format(len(self.skipped_words)))
+        self.Message.emit('\n\n'.join(messages))
         self.problem_words = []
+        self.broken_words = []
+        self.skipped_words = []
+
+    def save_broken_links(self):
+        if not self.broken_links:
+            return
+        try:
+            self.broken_links.save()
+        except (IOError, OSError):
+            # Broken links are just requested again next time
+            pass
 
     @pyqtSlot()
     def check_for_new_version(self):
@@ -436,23 +976,29 @@ class Download(QObject):
 
 
 class DownloadWorker(QRunnable):
-    def __init__(self, word, timeout, retries, sleep_seconds):
+    def __init__(self, word, timeout, controller, broken_links=None):
         QRunnable.__init__(self)
         self.word = word
         self.timeout = timeout
-        self.retries = retries
-        self.sleep_seconds = sleep_seconds
+        self.controller = controller
+        self.broken_links = broken_links
         self.signals = WorkerSignals()
 
     def run(self):
         try:
             # print('Downloading media for ' + self.word['wordValue'] + ' just started')
-            utils.send_to_download(self.word, self.timeout, self.retries, self.sleep_seconds)
-        except (urllib.error.URLError, socket.error):
-            # print("Problem with " + self.word['wordValue'])
-            self.signals.ProblemWord.emit(self.word.get('wordValue'))
+            utils.send_to_download(self.word, self.timeout, self.controller, self.broken_links)
+        except utils.KnownBrokenUrl:
+            self.signals.SkippedWord.emit(self.word.get('wordValue'))
+        except (urllib.error.URLError, socket.error) as e:
+            if retry.is_retryable_error(e):
+                # The word is retried later or reported as a problem one by Download
+                self.signals.Failed.emit(self.word)
+                return
+            # print("Broken link for " + self.word['wordValue'])
+            self.signals.BrokenWord.emit(self.word.get('wordValue'))
         # print('Worker for ' + self.word['wordValue'] + ' finished')
-        self.signals.Word.emit(self.word)
+        self.signals.Word.emit(utils.prepare_note_fields(self.word))
 
 
 class WorkerSignals(QObject):
@@ -460,8 +1006,22 @@ class WorkerSignals(QObject):
     Defines the signals for a worker thread.
     """
     Word = pyqtSignal(dict)
-    ProblemWord = pyqtSignal(str)
+    BrokenWord = pyqtSignal(str)
+    SkippedWord = pyqtSignal(str)
+    Failed = pyqtSignal(dict)
+
+
+WORDS_URL = 'api.lingualeo.com/GetWords'
+ISAUTHORIZED_URL = 'api.lingualeo.com/isauthorized'
+WORDSETS_URL = 'api.lingualeo.com/GetWordSets'
 
+# Responses used without asking the server during cacheTTL.
+# Pages of words are always revalidated: words added on the site must be imported right away,
+# and a stale first page (sizes of date groups) mustn't be mixed with the fresh next pages.
+TTL_CACHED_URLS = (WORDSETS_URL,)
+
+# Status codes of API errors that mean the session was rejected, see is_authorization_error
+AUTHORIZATION_ERROR_CODES = (401, 403)
 
 # New API requires list of attributes
 WORDS_ATTRIBUTE_LIST = {"id": "id", "wordValue": "wd", "origin": "wo", "wordType": "wt",
@@ -472,6 +1032,20 @@ WORDS_ATTRIBUTE_LIST = {"id": "id", "wordValue": "wd", "origin": "wo", "wordType
                         "combinedTranslation": "trc", "picture": "pic", "speechPartId": "pid",
                         "wordLemmaId": "lid", "wordLemmaValue": "lwd"}
 
+# Only the attributes that are used to fill the notes and download media
+MINIMAL_WORDS_ATTRIBUTE_LIST = {"id": "id", "wordValue": "wd", "created": "cd", "translations": "trs",
+                                "transcription": "scr", "pronunciation": "pron",
+                                "combinedTranslation": "trc", "picture": "pic"}
+
+WORDSETS_WORDS_ATTRIBUTE_LIST = dict(MINIMAL_WORDS_ATTRIBUTE_LIST, wordSets="ws", listWordSets="listWordSets")
+
+WORDS_ATTRIBUTE_PROFILES = {'minimal': MINIMAL_WORDS_ATTRIBUTE_LIST,
+                            'wordsets': WORDSETS_WORDS_ATTRIBUTE_LIST,
+                            'full': WORDS_ATTRIBUTE_LIST}
+
+LEMMA_WORDS_ATTRIBUTE_PROFILES = dict((name, dict(attributes, wordLemmaId="lid"))
+                                      for name, attributes in WORDS_ATTRIBUTE_PROFILES.items())
+
 WORDSETS_ATTRIBUTE_LIST = {"type": "type", "id": "id", "name": "name", "countWords": "cw",
                            "countWordsLearned": "cl", "wordSetId": "wordSetId", "picture": "pic",
                            "category": "cat", "status": "st", "source": "src"}
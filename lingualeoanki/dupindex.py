@@ -0,0 +1,80 @@
+"""
+In-memory index of the notes of LinguaLeo_model by their 'en' field.
+Values are normalized (Unicode NFC, case folding, whitespace folding),
+so the words that differ only by these are treated as the same word.
+"""
+import unicodedata
+
+
+def normalize(value):
+    """
+    :param value: str
+    :return: normalized str to compare the words
+    """
+    if not value:
+        return ''
+    value = unicodedata.normalize('NFC', value)
+    # casefold is not available in Python 2
+    value = value.casefold() if hasattr(value, 'casefold') else value.lower()
+    return ' '.join(unicodedata.normalize('NFC', value).split())
+
+
+class DuplicateIndex(object):
+    def __init__(self, model_id):
+        self.model_id = model_id
+        # normalized value -> set of note ids
+        self.notes = {}
+        # note id -> value as it is in the note (without HTML and media)
+        self.values = {}
+        # Number of notes of the model and the last modification time, to notice changes made outside the add-on
+        self.signature = None
+
+    def build(self, collection, get_first_field):
+        """
+        :param collection: Anki collection
+        :param get_first_field: function that returns the text of the first field from the note's fields
+        """
+        self.notes = {}
+        self.values = {}
+        for note_id, note_fields in collection.db.all('select id, flds from notes where mid = ?', self.model_id):
+            self.add(get_first_field(note_fields), note_id)
+        self.update_signature(collection)
+
+    def is_valid(self, collection):
+        return self.signature == self.get_signature(collection)
+
+    def update_signature(self, collection):
+        """
+        Call after the add-on itself has changed the notes and updated the index
+        """
+        self.signature = self.get_signature(collection)
+
+    def get_signature(self, collection):
+        return tuple(collection.db.first('select count(), max(mod) from notes where mid = ?', self.model_id))
+
+    def add(self, value, note_id):
+        key = normalize(value)
+        if key:
+            self.notes.setdefault(key, set()).add(note_id)
+            self.values[note_id] = value
+
+    def remove(self, value, note_id):
+        note_ids = self.notes.get(normalize(value))
+        if note_ids:
+            note_ids.discard(note_id)
+        self.values.pop(note_id, None)
+
+    def find(self, word_values, exact=False):
+        """
+        :param word_values: list of str
+        :param exact: find only the notes with exactly the same value, not just the same normalized one
+        :return: dict of word value -> set of note ids (only for the words that exist)
+        """
+        duplicates = {}
+        for word_value in word_values:
+            note_ids = self.notes.get(normalize(word_value))
+            if note_ids and exact:
+                note_ids = [note_id for note_id in note_ids if self.values.get(note_id) == word_value]
+            if note_ids:
+                duplicates[word_value] = set(note_ids)
+        return duplicates
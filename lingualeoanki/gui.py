@@ -5,7 +5,15 @@ from aqt.utils import showInfo
 from aqt.qt import *
 # TODO: change to:  import connect as connector
 from . import connect
+from . import importplan
+from . import notemap
+from . import scheduler
 from . import utils
+try:
+    from . import async_connect
+except (ImportError, SyntaxError):
+    # asyncio engine is not available on Python 2 (Anki 2.0)
+    async_connect = None
 from . import styles
 from ._name import ADDON_NAME
 from ._version import VERSION
@@ -18,16 +26,27 @@ from ._version import VERSION
 
 class PluginWindow(QDialog):
     Authorize = pyqtSignal()
-    RequestWords = pyqtSignal(str, list, bool)
+    RequestWords = pyqtSignal(str, list, bool, bool)
     RequestWordsets = pyqtSignal(str)
     CheckVersion = pyqtSignal()
     StartDownload = pyqtSignal(list)
+    EstimateMedia = pyqtSignal(list)
+    CommitSnapshot = pyqtSignal()
+    InvalidateCache = pyqtSignal()
 
     def __init__(self, parent=None):
         QDialog.__init__(self, parent)
         self.config = utils.get_config()
         self.is_active_download = False
         self.is_active_connection = False
+        # Downloaded words are added to the collection in batches
+        self.pending_words = []
+        self.import_counts = {}
+        self.NOTE_BATCH_SIZE = max(1, self.config.get('noteBatchSize', 200))
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(self.config.get('noteFlushInterval', 1000))
+        self.flush_timer.timeout.connect(self.flush_words)
 
         # Initialize UI
         ###############
@@ -71,6 +90,15 @@ class PluginWindow(QDialog):
         self.status_button_group.addButton(self.rbutton_learned, 3)
 
         self.checkBoxUpdateNotes = QCheckBox('Update existing notes')
+        self.checkBoxOnlyNew = QCheckBox('Only added since last import')
+        self.checkBoxOnlyNew.setToolTip('Import only new and changed words. Only requests for all words '
+                                        'stop at the words imported before; filtering by status or '
+                                        'dictionary still requests all matching words')
+        self.checkBoxDryRun = QCheckBox('Dry run')
+        self.checkBoxDryRun.setToolTip('Only show what would be imported, without changing the collection')
+        self.checkBoxRecheckLinks = QCheckBox('Re-check broken links')
+        self.checkBoxRecheckLinks.setToolTip('Try to download media with the links '
+                                             'that were broken during previous imports')
         self.progressLabel = QLabel('')
         self.progressBar = QProgressBar()
 
@@ -117,6 +145,9 @@ class PluginWindow(QDialog):
         options_layout.addWidget(self.rbutton_learned)
         options_layout.addSpacing(15)
         options_layout.addWidget(self.checkBoxUpdateNotes)
+        options_layout.addWidget(self.checkBoxOnlyNew)
+        options_layout.addWidget(self.checkBoxDryRun)
+        options_layout.addWidget(self.checkBoxRecheckLinks)
         options_layout.addStretch()
 
         # Progress label and progress bar layout
@@ -255,8 +286,18 @@ class PluginWindow(QDialog):
 
         if hasattr(self, 'lingualeo_thread'):
             self.stop_thread(self.lingualeo_thread)
+            if self.use_asyncio():
+                self.lingualeo_thread.lingualeo.cancel_tasks()
+        if hasattr(self, 'planner'):
+            self.planner.cancel()
         if hasattr(self, 'download_thread'):
             self.stop_thread(self.download_thread)
+            if self.use_asyncio():
+                self.download_thread.downloader.cancel_tasks()
+        if self.pending_words:
+            # Keep the words that were already downloaded
+            self.flush_words()
+            self.save_note_map()
 
         # Delete attribute before closing to allow running the add-on again
         if hasattr(mw, ADDON_NAME):
@@ -287,23 +328,32 @@ class PluginWindow(QDialog):
             self.Authorize.disconnect(self.lingualeo_thread.lingualeo.authorize)
             self.lingualeo_thread.lingualeo.AuthorizationStatus.disconnect(self.process_authorization)
             self.lingualeo_thread.lingualeo.Words.disconnect(self.download_words)
+            self.lingualeo_thread.lingualeo.WordsProgress.disconnect(self.show_words_progress)
+            self.lingualeo_thread.lingualeo.ConnectionStats.disconnect(self.remember_connection_stats)
             self.lingualeo_thread.lingualeo.Wordsets.disconnect(self.process_wordsets)
             self.lingualeo_thread.lingualeo.Busy.disconnect(self.set_busy_connecting)
             self.RequestWords.disconnect(self.lingualeo_thread.lingualeo.get_words_to_add)
             self.RequestWordsets.disconnect(self.lingualeo_thread.lingualeo.get_wordsets)
+            self.CommitSnapshot.disconnect(self.lingualeo_thread.lingualeo.commit_snapshot)
+            self.InvalidateCache.disconnect(self.lingualeo_thread.lingualeo.invalidate_cache)
             # Delete previous LinguaLeo object
             # TODO: Investigate if it should be done differently
             self.lingualeo_thread.lingualeo.deleteLater()
-        lingualeo = connect.Lingualeo(login, password, cookies_path)
+        lingualeo_class = async_connect.AsyncLingualeo if self.use_asyncio() else connect.Lingualeo
+        lingualeo = lingualeo_class(login, password, cookies_path)
         lingualeo.moveToThread(self.lingualeo_thread)
         lingualeo.Error.connect(self.showErrorMessage)
         self.Authorize.connect(lingualeo.authorize)
         lingualeo.AuthorizationStatus.connect(self.process_authorization)
         lingualeo.Words.connect(self.download_words)
+        lingualeo.WordsProgress.connect(self.show_words_progress)
+        lingualeo.ConnectionStats.connect(self.remember_connection_stats)
         lingualeo.Wordsets.connect(self.process_wordsets)
         lingualeo.Busy.connect(self.set_busy_connecting)
         self.RequestWords.connect(lingualeo.get_words_to_add)
         self.RequestWordsets.connect(lingualeo.get_wordsets)
+        self.CommitSnapshot.connect(lingualeo.commit_snapshot)
+        self.InvalidateCache.connect(lingualeo.invalidate_cache)
         self.lingualeo_thread.lingualeo = lingualeo
 
     @pyqtSlot(bool)
@@ -334,44 +384,122 @@ class PluginWindow(QDialog):
         # TODO: Change 'Exit' Button label to 'Stop' and back
         status = self.get_progress_status()
         with_context = self.api_rbutton_old.isChecked()
-        self.RequestWords.emit(status, wordsets, with_context)
+        only_new = self.checkBoxOnlyNew.isChecked()
+        if self.checkBoxUpdateNotes.isChecked():
+            # User wants the latest translations and media, don't use cached responses
+            self.InvalidateCache.emit()
+        self.RequestWords.emit(status, wordsets, with_context, only_new)
         self.show_progress_bar(True, 'Requesting list of words...')
 
+    @pyqtSlot(int, int)
+    def show_words_progress(self, received, total):
+        """
+        Sizes of date groups are known after the first request,
+        so the progress bar shows how many of all words have been received
+        """
+        if not total:
+            return
+        self.progressBar.setRange(0, max(total, received))
+        self.progressBar.setValue(received)
+
+    @pyqtSlot(str)
+    def remember_connection_stats(self, stats):
+        """
+        Connection reuse and traffic of the requests to LinguaLeo, shown with the result of the import
+        """
+        self.connection_stats = stats
+
+    def add_connection_stats(self, msg):
+        stats = getattr(self, 'connection_stats', '')
+        return '{}\n\nRequests to LinguaLeo: {}'.format(msg, stats) if stats else msg
+
     @pyqtSlot(list)
     def download_words(self, words):
-        self.show_progress_bar(True, 'Found {} words. Excluding already existing...'.format(len(words)))
+        self.show_progress_bar(True, 'Found {} words. Excluding already existing...'.format(len(words)), len(words))
         self.update_window()
-        filtered = self.filter_words(words) if not self.checkBoxUpdateNotes.isChecked() else words
-        if filtered:
-            self.start_downloading_media(filtered)
+        self.dry_run = self.checkBoxDryRun.isChecked()
+        self.plan = importplan.ImportPlan(self.checkBoxUpdateNotes.isChecked())
+        self.prepare_note_map(self.dry_run)
+        # Words are planned in small portions to keep Anki responsive, closing the window stops it
+        self.is_active_download = True
+        self.planner = scheduler.TimeSlicedLoop(words, self.plan_words, parent=self)
+        self.planner.Progress.connect(self.progressBar.setValue)
+        self.planner.Finished.connect(self.planning_finished)
+        self.planner.start()
+
+    def prepare_note_map(self, dry_run):
+        """
+        Load the notes of the words remembered during previous imports.
+        :param dry_run: don't create the model if it doesn't exist
+        """
+        # Set Anki Model
+        if dry_run:
+            model = getattr(self, 'model', None) or utils.get_model(mw.col)
         else:
-            progress = self.get_progress_status()
-            msg = 'No %s words to download' % progress if progress != 'all' else 'No words to download'
-            showInfo(msg)
-            self.show_progress_bar(False, '')
-            self.allow_to_close(True)
-            self.logoutButton.setEnabled(True)
-            self.set_download_form_enabled(True)
-            self.activate_addon_window()
+            # Cheap when the model wasn't changed since the previous import
+            self.model = utils.prepare_model(mw.col, utils.fields, styles.model_css)
+            model = self.model
+        self.note_map = notemap.NoteMap(utils.get_note_map_path(mw.col))
+        self.note_map.validate(mw.col, model['id'] if model else None)
 
-    def filter_words(self, words):
+    def plan_words(self, words):
         """
-        Eliminates unnecessary to download words.
+        Decide what to do with every word: add it, update its note or skip it.
+        Notes of the words that aren't in the mapping yet are found by word values.
         We have to do it in main thread to query database for duplicates
         """
-        if not words:
-            return None
-        # Exclude duplicates
-        words = [word for word in words if not utils.is_duplicate(word.get('wordValue'))]
-        return words
+        word_values = [word.get('wordValue') for word in words]
+        # Words are mapped to notes only by exact values: notes of the mapped words are updated,
+        # and a note found by the normalized value (e.g. 'Apple' for 'apple') is only a reason to skip the word
+        self.note_map.add_duplicates(words, utils.find_duplicates(mw.col, word_values, exact=True))
+        self.plan.add_words(words, self.note_map, utils.find_duplicates(mw.col, word_values))
+
+    def planning_finished(self):
+        self.is_active_download = False
+        if self.dry_run:
+            self.show_progress_bar(True, 'Estimating size of media files...')
+            self.create_download_thread()
+            self.EstimateMedia.emit(self.plan.words)
+        elif self.plan.words:
+            self.start_downloading_media(self.plan.words)
+        else:
+            # Nothing to import, but the received words are already in the collection
+            self.CommitSnapshot.emit()
+            self.save_note_map()
+            progress = self.get_progress_status()
+            msg = 'No %s words to download' % progress if progress != 'all' else 'No words to download'
+            showInfo(self.add_connection_stats(msg))
+            self.reset_download_form()
+
+    @pyqtSlot(int, int)
+    def show_dry_run_result(self, media_files, media_kilobytes):
+        showInfo(self.add_connection_stats('Dry run: {}.\nAbout {} media files to download ({:.1f} MB).'.format(
+            self.plan.get_summary(), media_files, media_kilobytes / 1024.0)))
+        self.reset_download_form()
+
+    def reset_download_form(self):
+        self.show_progress_bar(False, '')
+        self.allow_to_close(True)
+        self.logoutButton.setEnabled(True)
+        self.set_download_form_enabled(True)
+        self.activate_addon_window()
+
+    def save_note_map(self):
+        try:
+            self.note_map.save()
+        except (IOError, OSError):
+            # Notes of the words that aren't in the mapping are found by their values next time
+            pass
 
     def start_downloading_media(self, words):
         # Activate progress bar
         label = 'Downloading {} words...'.format(len(words))
+        self.download_label = label
         self.show_progress_bar(True, label, len(words))
-        # Set Anki Model
-        if not hasattr(self, 'model'):
-            self.model = utils.prepare_model(mw.col, utils.fields, styles.model_css)
+        self.import_counts = {}
+        if self.checkBoxRecheckLinks.isChecked():
+            # Links that were broken during previous imports are requested again
+            utils.clean_broken_links()
 
         # Create and start a thread if it is a first run
         self.create_download_thread()
@@ -382,30 +510,65 @@ class PluginWindow(QDialog):
         if hasattr(self, 'download_thread'):
             return
         self.download_thread = QThread()
-        downloader = connect.Download()
+        downloader = async_connect.AsyncDownload() if self.use_asyncio() else connect.Download()
         downloader.moveToThread(self.download_thread)
         downloader.Word.connect(self.add_word)
         downloader.Counter.connect(self.progressBar.setValue)
         downloader.FinalCounter.connect(self.download_finished)
         downloader.Message.connect(self.showErrorMessage)
         downloader.Busy.connect(self.set_busy_download)
+        downloader.MediaEstimate.connect(self.show_dry_run_result)
+        downloader.Stats.connect(self.show_download_stats)
+        self.EstimateMedia.connect(downloader.estimate_media)
         self.CheckVersion.connect(downloader.check_for_new_version)
         self.StartDownload.connect(downloader.add_separately)
         self.download_thread.downloader = downloader
         self.download_thread.start()
 
+    @pyqtSlot(str)
+    def show_download_stats(self, stats):
+        self.progressLabel.setText('{}\n{}'.format(self.download_label, stats))
+
     def download_finished(self, final_count):
+        # All the words were emitted before the final counter
+        self.flush_words()
+        self.CommitSnapshot.emit()
+        self.save_note_map()
         mess = 'words have' if final_count != 1 else 'word has'
-        showInfo("{} {} been imported".format(final_count, mess))
+        msg = "{} {} been imported".format(final_count, mess)
+        if self.checkBoxUpdateNotes.isChecked():
+            msg += '\n{} notes added, {} updated, {} unchanged'.format(
+                self.import_counts.get(importplan.ADD, 0), self.import_counts.get(importplan.UPDATE, 0),
+                self.import_counts.get(importplan.UNCHANGED, 0))
+        showInfo(self.add_connection_stats(msg))
         self.set_elements_enabled(True)
         self.show_progress_bar(False, '')
 
     def add_word(self, word):
         """
         Note is an SQLite object in Anki so you need
-        to fill it out inside the main thread
+        to fill it out inside the main thread.
+        Words are buffered and added when the batch is full or after the flush interval.
+        """
+        self.pending_words.append(word)
+        if len(self.pending_words) >= self.NOTE_BATCH_SIZE:
+            self.flush_words()
+        elif not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush_words(self):
+        self.flush_timer.stop()
+        words, self.pending_words = self.pending_words, []
+        if words:
+            counts = utils.add_words(words, self.model, self.plan, self.note_map)
+            for result, count in counts.items():
+                self.import_counts[result] = self.import_counts.get(result, 0) + count
+
+    def use_asyncio(self):
+        """
+        Check if requests should run on asyncio event loop instead of blocking threads
         """
-        utils.add_word(word, self.model)
+        return self.config.get('engine') == 'asyncio' and async_connect is not None
 
     @pyqtSlot(bool)
     def set_busy_download(self, status):
@@ -477,6 +640,9 @@ class PluginWindow(QDialog):
         self.rbutton_learning.setEnabled(mode)
         self.rbutton_learned.setEnabled(mode)
         self.checkBoxUpdateNotes.setEnabled(mode)
+        self.checkBoxOnlyNew.setEnabled(mode)
+        self.checkBoxDryRun.setEnabled(mode)
+        self.checkBoxRecheckLinks.setEnabled(mode)
         self.api_rbutton_new.setEnabled(mode)
         # self.api_rbutton_old.setEnabled(mode)
         self.update_window()
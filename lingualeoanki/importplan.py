@@ -0,0 +1,73 @@
+"""
+Plan of an import: what to do with every received word.
+Duplicates are resolved once, while the plan is made,
+then the plan is applied without searching the collection again.
+"""
+from . import dupindex
+
+
+ADD = 'add'
+UPDATE = 'update'
+SKIP = 'skip'
+# Result of an update when the note already has the same content
+UNCHANGED = 'unchanged'
+
+
+class ImportPlan(object):
+    def __init__(self, update_existing=False):
+        """
+        :param update_existing: update notes of the words that are already in the collection
+        """
+        self.update_existing = update_existing
+        # word id -> (action, note id)
+        self.actions = {}
+        # Words to download media for and to add or update, in the order they were received
+        self.words = []
+        self.planned_values = set()
+        # Notes that are already planned to be updated or skipped by one of the words
+        self.planned_note_ids = set()
+
+    def set(self, word, action, note_id=None):
+        self.actions[word.get('id')] = (action, note_id)
+        if action != SKIP:
+            self.words.append(word)
+
+    def get(self, word):
+        """
+        :return: (action, note id) tuple
+        """
+        return self.actions.get(word.get('id'), (SKIP, None))
+
+    def count(self, action):
+        return sum(1 for planned_action, _ in self.actions.values() if planned_action == action)
+
+    def add_words(self, words, note_map, duplicates):
+        """
+        Plan the next part of received words
+        :param words: list of words
+        :param note_map: NoteMap with notes of already imported words (including the ones found by value)
+        :param duplicates: dict of word value -> set of note ids for these words, see utils.find_duplicates
+        """
+        for word in words:
+            word_value = word.get('wordValue')
+            note_id = note_map.get(word.get('id'))
+            normalized_value = dupindex.normalize(word_value)
+            if not normalized_value or (normalized_value in self.planned_values and note_id is None):
+                # Different words of LinguaLeo with the same value would become duplicate notes
+                self.set(word, SKIP)
+            elif note_id in self.planned_note_ids:
+                # Another word would overwrite the note on every import
+                self.set(word, SKIP)
+            elif note_id is not None:
+                self.set(word, UPDATE if self.update_existing else SKIP, note_id)
+                self.planned_note_ids.add(note_id)
+            elif word_value in duplicates:
+                # Note exists, but it isn't in the mapping
+                self.set(word, SKIP)
+            else:
+                self.set(word, ADD)
+            self.planned_values.add(normalized_value)
+
+    def get_summary(self):
+        return '{} words to add, {} to update, {} to skip'.format(self.count(ADD), self.count(UPDATE),
+                                                                   self.count(SKIP))
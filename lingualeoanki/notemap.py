@@ -0,0 +1,97 @@
+"""
+Persistent mapping of LinguaLeo word ids to ids of Anki notes.
+Lets the add-on find the note of a word without searching the collection,
+even if the word was renamed or re-translated in LinguaLeo.
+"""
+import os
+
+from . import codec
+
+
+class NoteMap(object):
+    """
+    Mapping is stored as json:
+    {"model": <id of LinguaLeo_model>, "notes": {"<word id>": <note id>}}
+    It belongs to one collection and one model, and is rebuilt if the model was recreated.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.model_id = None
+        self.notes = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = codec.loads(f.read())
+            self.model_id = data.get('model')
+            self.notes = data.get('notes', {})
+        except (IOError, ValueError, AttributeError):
+            # Mapping is rebuilt from the notes of the collection if it's broken
+            self.model_id = None
+            self.notes = {}
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(codec.dumps({'model': self.model_id, 'notes': self.notes}))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def get(self, word_id):
+        """
+        :return: note id or None
+        """
+        return self.notes.get(str(word_id))
+
+    def set(self, word_id, note_id):
+        if word_id is not None and note_id:
+            self.notes[str(word_id)] = note_id
+
+    def validate(self, collection, model_id):
+        """
+        Forget the notes that were deleted from the collection (or all of them, if the model was changed)
+        and the notes mapped to more than one word
+        :param collection: Anki collection
+        :param model_id: id of the model of the add-on's notes
+        """
+        if self.model_id != model_id:
+            self.model_id = model_id
+            self.notes = {}
+            return
+        existing = set(collection.db.list('select id from notes where mid = ?', model_id))
+        # A note mapped to several words would be updated with the values of each of them in turn
+        word_counts = {}
+        for note_id in self.notes.values():
+            word_counts[note_id] = word_counts.get(note_id, 0) + 1
+        self.notes = dict((word_id, note_id) for word_id, note_id in self.notes.items()
+                          if note_id in existing and word_counts[note_id] == 1)
+
+    def add_duplicates(self, words, duplicates):
+        """
+        Map the words that are not in the mapping yet to the notes found by their values.
+        Only unambiguous matches are remembered: one note with exactly the same value,
+        not mapped to another word, and only one of the words has this value.
+        Other words aren't mapped, so their notes are never updated with the values of a different word.
+        :param words: list of words
+        :param duplicates: dict of word value -> set of note ids with exactly the same value,
+                           see utils.find_duplicates
+        """
+        mapped_note_ids = set(self.notes.values())
+        value_counts = {}
+        for word in words:
+            value_counts[word.get('wordValue')] = value_counts.get(word.get('wordValue'), 0) + 1
+        for word in words:
+            word_value = word.get('wordValue')
+            note_ids = duplicates.get(word_value)
+            if not note_ids or len(note_ids) != 1 or value_counts[word_value] != 1:
+                continue
+            note_id = next(iter(note_ids))
+            if self.get(word.get('id')) is None and note_id not in mapped_note_ids:
+                self.set(word.get('id'), note_id)
+                mapped_note_ids.add(note_id)
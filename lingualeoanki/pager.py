@@ -0,0 +1,95 @@
+"""
+Adaptive size of the pages of words requested from LinguaLeo.
+Page size grows while responses come faster than the target time
+and shrinks when they are slow or time out.
+The learned size is saved to be used from the start of the next session.
+"""
+import os
+import threading
+
+from . import codec
+
+
+# How many last pages to keep in the saved history
+HISTORY_LENGTH = 20
+
+
+class AdaptivePager(object):
+    def __init__(self, path, initial_size, min_size, max_size, target_seconds, enabled=True):
+        """
+        :param path: file to save learned page size (None not to save)
+        :param initial_size: page size to start with if nothing was learned yet
+        :param min_size: the smallest page size
+        :param max_size: the largest page size
+        :param target_seconds: desired response time of one page
+        :param enabled: if False, initial_size is always used
+        """
+        self.path = path
+        self.min_size = max(1, min(min_size, max_size))
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.size = self.clip(initial_size)
+        self.history = []
+        if enabled:
+            self.load()
+
+    def clip(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def get_size(self):
+        with self.lock:
+            return self.size
+
+    def record(self, page_size, words_received, seconds, received_bytes=None):
+        """
+        Adjust page size after a page was received
+        :param page_size: requested page size
+        :param words_received: number of words in the response
+        :param seconds: response time
+        :param received_bytes: size of the response as it was received
+        """
+        if not self.enabled or seconds <= 0:
+            return
+        with self.lock:
+            self.history = (self.history + [[page_size, words_received, round(seconds, 3), received_bytes]]
+                            )[-HISTORY_LENGTH:]
+            # Short last page of a group says little about the time of a full one, unless it was slow anyway
+            if words_received < page_size and seconds < self.target_seconds:
+                return
+            ideal = page_size * self.target_seconds / seconds
+            # Change gradually: not more than twice per page
+            ideal = max(page_size / 2.0, min(page_size * 2.0, ideal))
+            self.size = self.clip((self.size * ideal) ** 0.5)
+
+    def record_timeout(self):
+        """
+        Page was too large to be received in time
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.size = self.clip(self.size // 2)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = codec.loads(f.read())
+            self.size = self.clip(data['pageSize'])
+            self.history = data.get('history', [])
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        if not self.enabled or not self.path:
+            return
+        with self.lock:
+            data = {'pageSize': self.size, 'history': self.history}
+        try:
+            with open(self.path, 'wb') as f:
+                f.write(codec.dumps(data))
+        except (IOError, OSError):
+            pass
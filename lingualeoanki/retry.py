@@ -0,0 +1,72 @@
+"""
+Delays of repeated attempts to download media.
+Failed words wait for the next attempt outside of the download workers,
+with exponentially growing delays and random jitter, so the retries of many words
+don't hit the host at the same moment. Retries of one import end at a deadline.
+Only failures that may go away are retried: timeouts, connection errors,
+server errors (5xx), Request Timeout (408) and Too Many Requests (429).
+Broken links fail at once.
+"""
+import random
+import socket
+import time
+
+from .six.moves import urllib
+
+
+class PermanentError(urllib.error.URLError):
+    """
+    Failure that will happen again on the next attempt, e.g. an invalid url
+    """
+
+
+def is_retryable_error(error):
+    """
+    :param error: exception raised while downloading
+    :return: True if the next attempt may succeed
+    """
+    if isinstance(error, PermanentError):
+        return False
+    if isinstance(error, urllib.error.HTTPError):
+        # Other 4xx mean the link is broken (404, 410) or forbidden (403)
+        return error.code >= 500 or error.code in (408, 429)
+    return isinstance(error, (urllib.error.URLError, socket.error))
+
+
+class RetryScheduler(object):
+    def __init__(self, attempts, base_delay, max_delay, time_limit):
+        """
+        :param attempts: maximum number of attempts to download media of a word (including the first one)
+        :param base_delay: seconds to wait after the first failure, doubled after each next one
+        :param max_delay: maximum seconds to wait before one attempt
+        :param time_limit: seconds after the first failure of an import during which words are retried
+        """
+        self.attempts = max(1, attempts)
+        self.base_delay = max(0, base_delay)
+        self.max_delay = max(self.base_delay, max_delay)
+        self.time_limit = time_limit
+        self.deadline = None
+
+    def reset(self):
+        """
+        Call before the next import
+        """
+        self.deadline = None
+
+    def get_delay(self, failures):
+        """
+        :param failures: number of failed attempts of the word so far
+        :return: seconds to wait before the next attempt or None if the word shouldn't be retried
+        """
+        if failures >= self.attempts:
+            return None
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        # Equal jitter: at least half of the delay, so waiting still grows with failures
+        delay = random.uniform(delay / 2.0, delay)
+        now = time.time()
+        if self.deadline is None:
+            # Words wait at the same time, so the limit is measured by the clock, not by the sum of delays
+            self.deadline = now + self.time_limit
+        if now + delay > self.deadline:
+            return None
+        return delay
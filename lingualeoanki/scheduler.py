@@ -0,0 +1,54 @@
+"""
+Cooperative processing of long lists on the main thread.
+Work that has to be done in the main thread (e.g. queries to Anki's database)
+is split into chunks, and control is returned to Qt event loop between time slices,
+so Anki and the add-on window stay responsive.
+"""
+import time
+
+from aqt.qt import *
+
+
+class TimeSlicedLoop(QObject):
+    Progress = pyqtSignal(int)
+    Finished = pyqtSignal()
+
+    def __init__(self, items, process_chunk, chunk_size=200, slice_seconds=0.05, parent=None):
+        """
+        :param items: list of items to process
+        :param process_chunk: function that receives a list of not more than chunk_size items
+        :param chunk_size: number of items processed at once
+        :param slice_seconds: time to process chunks before letting the event loop run
+        """
+        QObject.__init__(self, parent)
+        self.items = items
+        self.process_chunk = process_chunk
+        self.chunk_size = max(1, chunk_size)
+        self.slice_seconds = slice_seconds
+        self.position = 0
+        self.cancelled = False
+
+    def start(self):
+        QTimer.singleShot(0, self.run_slice)
+
+    def cancel(self):
+        """
+        Stop before the next chunk, Finished is not emitted
+        """
+        self.cancelled = True
+
+    def run_slice(self):
+        start = time.time()
+        while not self.cancelled and self.position < len(self.items):
+            chunk = self.items[self.position:self.position + self.chunk_size]
+            self.process_chunk(chunk)
+            self.position += len(chunk)
+            if time.time() - start >= self.slice_seconds:
+                break
+        if self.cancelled:
+            return
+        self.Progress.emit(self.position)
+        if self.position < len(self.items):
+            QTimer.singleShot(0, self.run_slice)
+        else:
+            self.Finished.emit()
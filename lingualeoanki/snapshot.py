@@ -0,0 +1,141 @@
+"""
+Local snapshot of user's LinguaLeo vocabulary.
+Keeps ids, creation dates and fingerprints of imported words for each wordset,
+so the next import can request only new words and skip unchanged ones.
+"""
+import hashlib
+import os
+import threading
+
+from . import codec
+
+
+# Word attributes that end up in a note; if any of them changes, the word is imported again
+FINGERPRINT_ATTRIBUTES = ['wordValue', 'combinedTranslation', 'transcription', 'pronunciation', 'picture']
+
+
+def get_fingerprint(word):
+    """
+    :param word: dict
+    :return: str with a hash of the word's content
+    """
+    values = [word.get(attribute) or '' for attribute in FINGERPRINT_ATTRIBUTES]
+    translations = word.get('translations')
+    if translations:
+        values += [translations[0].get('ctx') or '', translations[0].get('pic') or '']
+    return hashlib.md5(codec.dumps(values)).hexdigest()
+
+
+def get_key(wordset_id, status):
+    """
+    Words requested with different status filters are different subsets of the wordset,
+    so each pair of them has its own sync point
+    """
+    return '{}:{}'.format(wordset_id, status)
+
+
+def is_older(created, sync_point):
+    """
+    Compare creation dates of the words as they are received from LinguaLeo
+    """
+    if created is None or sync_point is None or type(created) != type(sync_point):
+        return True
+    return created <= sync_point
+
+
+class VocabularySnapshot(object):
+    """
+    Snapshot is stored as json:
+    {"wordsets": {"<wordset_id>:<status>": {"synced": <created of the newest word>,
+                                            "words": {"<word id>": [<created>, <fingerprint>]}}}}
+    Words received from LinguaLeo are staged first and written to the snapshot
+    only after they were imported, with commit().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wordsets = {}
+        self.staged = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self.wordsets = codec.loads(f.read()).get('wordsets', {})
+        except (IOError, ValueError, AttributeError):
+            # Snapshot is only an optimization, start from scratch if it's broken
+            self.wordsets = {}
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(codec.dumps({'wordsets': self.wordsets}))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def get_sync_point(self, key):
+        return self.wordsets.get(key, {}).get('synced')
+
+    def is_known_territory(self, key, words):
+        """
+        Words come from the newest to the oldest,
+        so as soon as one of them was already synced, the rest are known too
+        :param key: see get_key
+        :param words: list of received words
+        :return: bool
+        """
+        wordset = self.wordsets.get(key)
+        if not wordset:
+            return False
+        known_words = wordset['words']
+        sync_point = wordset.get('synced')
+        for word in words:
+            if str(word.get('id')) in known_words and is_older(word.get('created'), sync_point):
+                return True
+        return False
+
+    def stage_words(self, key, words):
+        """
+        Stage received words and return only new or changed ones
+        :param key: see get_key
+        :param words: list of received words
+        :return: list of words
+        """
+        known_words = self.wordsets.get(key, {}).get('words', {})
+        changed = []
+        staged = {}
+        for word in words:
+            word_id = str(word.get('id'))
+            fingerprint = get_fingerprint(word)
+            known = known_words.get(word_id)
+            if not known or known[1] != fingerprint:
+                changed.append(word)
+            staged[word_id] = [word.get('created'), fingerprint]
+        with self.lock:
+            self.staged.setdefault(key, {}).update(staged)
+        return changed
+
+    def commit(self):
+        """
+        Write staged words to the snapshot and save it to disk
+        """
+        with self.lock:
+            staged, self.staged = self.staged, {}
+        if not staged:
+            return
+        for key, words in staged.items():
+            wordset = self.wordsets.setdefault(key, {'synced': None, 'words': {}})
+            wordset['words'].update(words)
+            for created, _ in words.values():
+                if created is not None and (wordset['synced'] is None or not is_older(created, wordset['synced'])):
+                    wordset['synced'] = created
+        self.save()
+
+    def discard(self):
+        with self.lock:
+            self.staged = {}
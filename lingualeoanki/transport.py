@@ -0,0 +1,344 @@
+"""
+Persistent (keep-alive) HTTP transport for requests to LinguaLeo.
+Connections are kept open and reused per host, so a long chain of API calls
+pays for TCP and TLS handshakes only once.
+"""
+import base64
+import errno
+import io
+import socket
+import threading
+import time
+import zlib
+
+from .six.moves import http_client
+from .six.moves import urllib
+
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+ACCEPT_ENCODING = 'gzip, deflate'
+# Socket errors that mean that the server has closed the connection
+STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+try:
+    STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+except NameError:
+    # Python 2 has only errno of socket.error
+    STALE_CONNECTION_ERRORS = ()
+
+
+class Response(object):
+    """
+    Completely read response of the ConnectionPool.
+    Mimics the part of urllib's response interface used by the add-on and the cookie jar.
+    """
+    def __init__(self, url, status, reason, headers, body, reused, raw_size=None, elapsed=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        # True if the request was sent over already established connection
+        self.reused = reused
+        # Size of the body as it was received (compressed), and after decompression
+        self.raw_size = len(body) if raw_size is None else raw_size
+        self.size = len(body)
+        # Seconds from sending the request to receiving the whole body
+        self.elapsed = elapsed
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle connections per (scheme, host, port) and reuses them for next requests.
+    Safe to use from several threads: a connection is used by one request at a time.
+    """
+    def __init__(self, cookie_jar=None, context=None, timeout=None, max_idle_per_host=4):
+        """
+        :param cookie_jar: CookieJar to add cookies to requests and extract them from responses
+        :param context: ssl.SSLContext for https connections (default one is used if None)
+        :param timeout: socket timeout in seconds
+        :param max_idle_per_host: how many idle connections to keep for each host
+        """
+        self.cookie_jar = cookie_jar
+        self.context = context
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        # (scheme, host, port) -> proxy for the host or None, see get_proxy
+        self._proxies = {}
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'reused': 0, 'opened': 0, 'raw_bytes': 0, 'decoded_bytes': 0}
+
+    def set_context(self, context):
+        """
+        Replace SSL context (e.g. with unverified one) and drop connections opened with the old context
+        """
+        self.close()
+        self.context = context
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return '{} requests, {} over reused connections, {} connections opened, ' \
+               '{:.1f} KB received ({:.1f} KB decompressed)'.format(stats['requests'], stats['reused'],
+                                                                    stats['opened'], stats['raw_bytes'] / 1024.0,
+                                                                    stats['decoded_bytes'] / 1024.0)
+
+    def open(self, request):
+        """
+        Send request and read the whole response.
+        Follows redirects and raises the same exceptions as urllib opener does.
+        :param request: url string or urllib.request.Request
+        :return: Response
+        """
+        if not isinstance(request, urllib.request.Request):
+            request = urllib.request.Request(request)
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._open_once(request)
+            if response.status not in REDIRECT_CODES or not response.headers.get('Location'):
+                break
+            request = get_redirect_request(request, response)
+        raise_for_status(response)
+        return response
+
+    def _open_once(self, request):
+        url = request.get_full_url()
+        key, path, headers, data = self.prepare_request(request)
+        start = time.time()
+        proxy = self.get_proxy(key)
+        if proxy and key[0] == 'http':
+            # Plain http requests are sent to the proxy with the full url
+            path = url.split('#')[0]
+            if proxy[2]:
+                headers['Proxy-Authorization'] = proxy[2]
+        connection, reused = self._acquire(key)
+        try:
+            raw = self._send(connection, request.get_method(), path, data, headers)
+        except (urllib.error.URLError, socket.error) as e:
+            connection.close()
+            if not reused or not is_stale_connection_error(e):
+                # Timeout means the server may be still processing the request, it's not sent again
+                raise
+            # Server has closed idle connection, repeat once with a fresh one
+            connection, reused = self._create(key), False
+            raw = self._send(connection, request.get_method(), path, data, headers)
+
+        try:
+            raw_body = raw.read()
+        except http_client.HTTPException as e:
+            connection.close()
+            raise urllib.error.URLError(e)
+        body = decode_body(raw_body, raw.getheader('Content-Encoding'))
+        response = Response(url, raw.status, raw.reason, raw.msg, body, reused, len(raw_body), time.time() - start)
+        if raw.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        self.process_response(request, response)
+        return response
+
+    def prepare_request(self, request):
+        """
+        Add cookies and default headers to the request
+        :param request: urllib.request.Request
+        :return: tuple of connection key, path, headers and body
+        """
+        parts = urllib.parse.urlsplit(request.get_full_url())
+        key = get_connection_key(request.get_full_url())
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if self.cookie_jar is not None:
+            self.cookie_jar.add_cookie_header(request)
+        headers = dict(request.header_items())
+        headers.setdefault('Host', parts.netloc)
+        if not any(name.lower() == 'accept-encoding' for name in headers):
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        data = request.data if hasattr(request, 'data') else request.get_data()
+        return key, path, headers, data
+
+    def process_response(self, request, response):
+        """
+        Count the response in statistics and save its cookies
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            if response.reused:
+                self.stats['reused'] += 1
+            self.stats['raw_bytes'] += response.raw_size
+            self.stats['decoded_bytes'] += response.size
+        if self.cookie_jar is not None:
+            self.cookie_jar.extract_cookies(response, request)
+
+    @staticmethod
+    def _send(connection, method, path, data, headers):
+        try:
+            connection.request(method, path, data, headers)
+            return connection.getresponse()
+        except http_client.HTTPException as e:
+            connection.close()
+            # Callers expect urllib exceptions, not the ones of http client
+            raise urllib.error.URLError(e)
+
+    def _acquire(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop(), True
+        return self._create(key), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def get_proxy(self, key):
+        """
+        Proxy is looked up once for every host, as urllib's ProxyHandler does it once for an opener
+        :return: tuple of proxy host, port and Proxy-Authorization header (or None), or None without proxy
+        """
+        with self._lock:
+            if key in self._proxies:
+                return self._proxies[key]
+        proxy = get_proxy(key[0], key[1])
+        with self._lock:
+            self._proxies[key] = proxy
+        return proxy
+
+    def _create(self, key):
+        scheme, host, port = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        proxy = self.get_proxy(key)
+        if scheme == 'https':
+            if self.context is not None:
+                kwargs['context'] = self.context
+            if proxy:
+                # TLS connection to the host is tunneled through the proxy with CONNECT
+                connection = http_client.HTTPSConnection(proxy[0], proxy[1], **kwargs)
+                connection.set_tunnel(host, port, {'Proxy-Authorization': proxy[2]} if proxy[2] else None)
+            else:
+                connection = http_client.HTTPSConnection(host, port, **kwargs)
+        elif proxy:
+            connection = http_client.HTTPConnection(proxy[0], proxy[1], **kwargs)
+        else:
+            connection = http_client.HTTPConnection(host, port, **kwargs)
+        with self._lock:
+            self.stats['opened'] += 1
+        return connection
+
+
+def get_connection_key(url):
+    """
+    :return: (scheme, host, port) tuple, connections are kept for each of them
+    """
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme, parts.hostname, parts.port
+
+
+def get_proxy(scheme, host):
+    """
+    Find the proxy for the host the same way urllib does:
+    in environment variables (e.g. HTTPS_PROXY, NO_PROXY) or in the system settings
+    :return: tuple of proxy host, port and Proxy-Authorization header (or None), or None without proxy
+    """
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    parts = urllib.parse.urlsplit(proxy)
+    authorization = None
+    if parts.username:
+        credentials = '{}:{}'.format(urllib.parse.unquote(parts.username), urllib.parse.unquote(parts.password or ''))
+        authorization = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    return parts.hostname, parts.port or 80, authorization
+
+
+def is_stale_connection_error(error):
+    """
+    Errors that mean that the server has closed the reused connection, so the request can be repeated.
+    Timeouts are not among them: the request may have reached the server.
+    """
+    if isinstance(error, urllib.error.URLError):
+        error = error.reason
+    if isinstance(error, http_client.BadStatusLine):
+        # Includes RemoteDisconnected and an empty status line
+        return True
+    if isinstance(error, STALE_CONNECTION_ERRORS):
+        return True
+    return isinstance(error, socket.error) and getattr(error, 'errno', None) in STALE_CONNECTION_ERRNOS
+
+
+def decode_body(body, content_encoding):
+    """
+    Decompress the body according to Content-Encoding header
+    :param body: bytes
+    :param content_encoding: str or None
+    :return: bytes
+    """
+    encoding = (content_encoding or '').strip().lower()
+    if not body or encoding in ('', 'identity'):
+        return body
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                # Some servers send raw deflate stream without zlib header
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise urllib.error.URLError('Unable to decompress response: ' + str(e))
+    return body
+
+
+def raise_for_status(response):
+    """
+    Raise HTTPError for error responses as urllib does
+    """
+    if response.status >= 400:
+        raise urllib.error.HTTPError(response.url, response.status, response.reason,
+                                     response.headers, io.BytesIO(response.body))
+
+
+def get_redirect_request(request, response):
+    """
+    Build a request to follow redirect the same way urllib does:
+    307 and 308 repeat the method and the body, others switch to GET
+    """
+    new_url = urllib.parse.urljoin(request.get_full_url(), response.headers.get('Location'))
+    headers = dict((k, v) for k, v in request.header_items()
+                   if k.lower() not in ('content-length', 'content-type', 'cookie', 'host'))
+    if response.status in (307, 308):
+        data = request.data if hasattr(request, 'data') else request.get_data()
+        headers.update((k, v) for k, v in request.header_items() if k.lower() == 'content-type')
+        return urllib.request.Request(new_url, data, headers)
+    return urllib.request.Request(new_url, headers=headers)
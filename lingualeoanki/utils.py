@@ -1,24 +1,26 @@
 import os
-from random import randint
+from random import randint, sample
 import json
 from .six.moves import urllib
 import socket
 import ssl
 import locale
 import sys
-import time
+import hashlib
+import tempfile
 
 from aqt import mw
-from aqt.utils import showInfo  # TODO: remove when search problem is fixed
 from anki import notes
 
 try:
-    from anki.rsbackend import InvalidInput  # TODO: Check if it actually breaks earlier versions
+    from anki.utils import strip_html_media
 except ImportError:
-    # define our class to avoid error on earlier versions
-    class InvalidInput(Exception):
-        pass
+    # Anki < 2.1.50
+    from anki.utils import stripHTMLMedia as strip_html_media
 
+from . import dupindex
+from . import importplan
+from . import retry
 from . import styles
 from ._version import VERSION
 
@@ -27,15 +29,26 @@ fields = ['en', 'transcription',
           'ru', 'picture_name',
           'sound_name', 'context']
 
-# TODO: Check anki versioning and find a better fix
-try:
-    from anki import buildinfo
-    anki_version = buildinfo.version.split('.')[-1]
-    anki_version = int(anki_version)
-except:
-    print("Can't find or parse anki_version")
-    # it means that it's definitely less then 2.1.23
-    anki_version = 20
+# Key of the word dict to keep the values of note fields computed by prepare_note_fields
+NOTE_FIELDS_KEY = 'noteFields'
+
+UNDO_LABEL = 'Import from LinguaLeo'
+
+# Collection path -> (id, modification time) of LinguaLeo_model, see prepare_model
+resolved_models = {}
+
+# Collection path -> DuplicateIndex, built once per session, see get_duplicate_index
+duplicate_indexes = {}
+
+# Number of media files requested to estimate the size of all of them
+MEDIA_SAMPLE_SIZE = 20
+
+# Media files are downloaded by parts of this size
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Permissions of the downloaded media files. Temporary files are created readable only by the owner,
+# and the process umask can't be read without changing it for all threads of Anki
+MEDIA_FILE_MODE = 0o644
 
 
 def create_templates(collection):
@@ -73,29 +86,98 @@ def is_model_exist(collection, fields):
     return name_exist and fields_ok
 
 
+def get_model(collection):
+    """
+    Returns the model of the add-on's notes without creating or changing it
+    :return: model or None if it doesn't exist yet
+    """
+    if is_model_exist(collection, fields):
+        return collection.models.byName('LinguaLeo_model')
+    return None
+
+
 def prepare_model(collection, fields, model_css):
     """
     Returns a model for our future notes.
     Creates a deck to keep them.
+    Model is saved only if it was created or changed: saving a model may require a full sync.
+    Resolved model is remembered until it's modified, e.g. in the Anki's notetype editor.
     """
+    cached = resolved_models.get(collection.path)
+    if cached:
+        model = collection.models.get(cached[0])
+        # The deck could be deleted since the model was resolved
+        if model and model['mod'] == cached[1] and collection.decks.get(model.get('did'), default=False):
+            return model
+    is_changed = False
     if is_model_exist(collection, fields):
         model = collection.models.byName('LinguaLeo_model')
     else:
         model = create_new_model(collection, fields, model_css)
+        is_changed = True
     # TODO: Move Deck name to config?
     # Create a deck "LinguaLeo" and write id to deck_id
-    model['did'] = collection.decks.id('LinguaLeo')
-    collection.models.setCurrent(model)
-    collection.models.save(model)
+    deck_id = collection.decks.id('LinguaLeo')
+    if model.get('did') != deck_id:
+        model['did'] = deck_id
+        is_changed = True
+    current_model = collection.models.current()
+    if not current_model or current_model['id'] != model['id']:
+        collection.models.setCurrent(model)
+    if is_changed:
+        collection.models.save(model)
+    resolved_models[collection.path] = (model['id'], model['mod'])
     return model
 
 
-def send_to_download(word, timeout, retries, sleep_seconds):
-    # try to download the picture and the sound the specified number of times,
-    # if not succeeded, raise the last error happened to be shown as a problem word
+class InvalidMediaUrl(retry.PermanentError):
+    """
+    Media url that can't be requested, so there is no point in trying again
+    """
+
+
+class KnownBrokenUrl(retry.PermanentError):
+    """
+    Media url that was broken during one of the previous imports, see brokenlinks
+    """
+
+
+def send_to_download(word, timeout, controller, broken_links=None):
+    """
+    Try to download the picture and the sound once.
+    If not succeeded, raise the error to retry the word later or to show it as a problem word,
+    see retry.is_retryable_error
+    :param broken_links: BrokenLinks to skip the urls that are known to be broken and to remember the new ones
+    """
+    known_broken_url = None
+    for url in get_media_urls(word):
+        if not is_valid_ascii(url):
+            raise InvalidMediaUrl('Invalid picture url: ' + url)
+        if broken_links and broken_links.is_broken(url):
+            known_broken_url = url
+            continue
+        try:
+            download_media_file(url, timeout, controller)
+        except urllib.error.HTTPError as e:
+            if broken_links and not retry.is_retryable_error(e):
+                broken_links.add(url)
+            raise
+    if known_broken_url:
+        raise KnownBrokenUrl('Broken media url: ' + known_broken_url)
+
+
+def get_media_urls(word):
+    """
+    Returns urls of the sound and the picture of the word.
+    Sound with invalid url is skipped, but invalid picture url is returned
+    for the word to be reported as a problem one.
+    :param word: dict
+    :return: list of str
+    """
+    urls = []
     sound_url = word.get('pronunciation')
     if sound_url and is_valid_ascii(sound_url):
-        try_downloading_media(sound_url, timeout, retries, sleep_seconds)
+        urls.append(sound_url)
 
     pic_url = word.get('picture')
     # TODO: Remove or refactor the following code that supports old API
@@ -106,48 +188,167 @@ def send_to_download(word, timeout, retries, sleep_seconds):
             pic_url = translation['pic']
     # End of old API code
     if pic_url and not is_default_picture(pic_url):
-        if not is_valid_ascii(pic_url):
-            raise urllib.error.URLError('Invalid picture url: ' + pic_url)
-        try_downloading_media(pic_url, timeout, retries, sleep_seconds)
-
-
-def try_downloading_media(url, timeout, retries, sleep_seconds):
-    exc_happened = None
-    for i in list(range(retries)):
-        exc_happened = None
-        try:
-            download_media_file(url, timeout)
-            break
-        except (urllib.error.URLError, socket.error) as e:
-            exc_happened = e
-            time.sleep(sleep_seconds)
-    if exc_happened:
-        raise exc_happened
+        urls.append(pic_url)
+    return urls
 
 
-def download_media_file(url, timeout):
+def get_media_path(url):
+    """
+    Returns a path in the media folder to save the file from url
+    or None if the file shouldn't be downloaded
+    """
     destination_folder = mw.col.media.dir()
     name = url.split('/')[-1]
     if is_default_picture(name):
-        return
+        return None
     name = get_valid_name(name)
     abs_path = os.path.join(destination_folder, name)
     if os.path.exists(abs_path):
         # No need to download file again if it already exists
+        return None
+    return abs_path
+
+
+def estimate_media_size(urls, timeout):
+    """
+    Estimate the size of the media files by the sizes of a few of them
+    :param urls: list of urls of the files to download
+    :return: number of bytes
+    """
+    sizes = []
+    for url in sample(urls, min(len(urls), MEDIA_SAMPLE_SIZE)):
+        size = get_media_file_size(url, timeout)
+        if size is not None:
+            sizes.append(size)
+    if not sizes:
+        return 0
+    return sum(sizes) * len(urls) // len(sizes)
+
+
+def get_media_file_size(url, timeout):
+    """
+    :return: Content-Length of the file or None if it's unknown
+    """
+    req = urllib.request.Request(url.replace('\n', ''))
+    req.get_method = lambda: 'HEAD'
+    try:
+        resp = urllib.request.urlopen(req, timeout=timeout, context=ssl._create_unverified_context())
+        return get_content_length(resp.info())
+    except (urllib.error.URLError, socket.error):
+        return None
+
+
+def download_media_file(url, timeout, controller):
+    """
+    :param controller: ConcurrencyController that limits the number of simultaneous requests to the host
+    """
+    abs_path = get_media_path(url)
+    if not abs_path:
         return
     # Fix '\n' symbols in the url (they were found in the long sentences)
     url = url.replace('\n', '')
-    # TODO: find a better way for unsecure connection
-    resp = urllib.request.urlopen(url, timeout=timeout, context=ssl._create_unverified_context())
-    content = resp.read()
-    with open(abs_path, "wb") as media_file:
-        media_file.write(content)
+    with controller.request(url) as result:
+        # TODO: find a better way for unsecure connection
+        resp = urllib.request.urlopen(url, timeout=timeout, context=ssl._create_unverified_context())
+        result['size'] = save_media_file(abs_path, iter(lambda: resp.read(MEDIA_CHUNK_SIZE), b''),
+                                         get_content_length(resp.info()))
 
 
-def fill_note(word, note):
-    note['en'] = word.get('wordValue')
+def save_media_file(abs_path, chunks, expected_size=None):
+    """
+    :param abs_path: path to the media file
+    :param chunks: iterable of bytes
+    :param expected_size: number of bytes to verify the size of the file (None not to verify)
+    :return: size of the file
+    """
+    media_file = MediaFile(abs_path)
+    try:
+        for chunk in chunks:
+            media_file.write(chunk)
+        return media_file.commit(expected_size)
+    except:
+        media_file.discard()
+        raise
+
+
+class MediaFile(object):
+    """
+    Media file is written to a temporary one in the same folder and moved in place only when it's complete,
+    so an interrupted download doesn't leave a truncated file that looks like a downloaded one
+    """
+    def __init__(self, abs_path):
+        self.abs_path = abs_path
+        handle, self.temp_path = tempfile.mkstemp(prefix='.lingualeo-', suffix='.part',
+                                                  dir=os.path.dirname(abs_path))
+        self.file = os.fdopen(handle, 'wb')
+        self.size = 0
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, expected_size=None):
+        """
+        :param expected_size: number of bytes to verify the size of the file (None not to verify)
+        :return: size of the file
+        """
+        self.file.close()
+        if expected_size is not None and self.size != expected_size:
+            raise urllib.error.URLError('Incomplete media file: received {} of {} bytes'.format(self.size,
+                                                                                                expected_size))
+        # Temporary file is only readable by the user, but media should look like the files Anki writes
+        os.chmod(self.temp_path, MEDIA_FILE_MODE)
+        replace_file(self.temp_path, self.abs_path)
+        return self.size
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+def replace_file(source, destination):
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        # Python 2
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def get_content_length(headers):
+    """
+    :return: int or None if the length is unknown
+    """
+    try:
+        return int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def prepare_note_fields(word):
+    """
+    Compute the values of note fields in advance, e.g. in the thread that downloads media,
+    so the main thread only copies them into the note
+    :param word: dict
+    :return: word
+    """
+    word[NOTE_FIELDS_KEY] = get_note_fields(word)
+    return word
+
+
+def get_note_fields(word):
+    """
+    :param word: dict
+    :return: dict with values of all the fields of the note
+    """
+    note_fields = dict((field, '') for field in fields)
+    note_fields['en'] = word.get('wordValue') or ''
     # print("Filling word {}".format(word['wd']))
-    note['ru'] = word.get('combinedTranslation')
+    note_fields['ru'] = word.get('combinedTranslation') or ''
     picture_name = word.get('picture').split('/')[-1] if word.get('picture') else ''
     # TODO: Remove old api code when not needed
     translations = word.get('translations')
@@ -155,92 +356,162 @@ def fill_note(word, note):
         # User's choice translation has index 0, then come translations sorted by votes (higher to lower)
         translation = translations[0]
         if translation.get('ctx'):
-            note['context'] = translation['ctx']
+            note_fields['context'] = translation['ctx']
         if translation.get('pic'):
             picture_name = translation['pic'].split('/')[-1]
     if picture_name and is_valid_ascii(picture_name) and \
             not is_default_picture(picture_name):
         picture_name = get_valid_name(picture_name)
-        note['picture_name'] = '<img src="%s" />' % picture_name
+        note_fields['picture_name'] = '<img src="%s" />' % picture_name
 
     # TODO: Investigate if it is possible to get context differently, since with API 1.0.1
     #  there is no context at the time of getting list of words
 
     if word.get('transcription'):
-        note['transcription'] = '[' + word['transcription'] + ']'
+        note_fields['transcription'] = '[' + word['transcription'] + ']'
     sound_url = word.get('pronunciation')
     if sound_url:
         sound_name = sound_url.split('/')[-1]
         sound_name = get_valid_name(sound_name)
-        note['sound_name'] = '[sound:%s]' % sound_name
+        note_fields['sound_name'] = '[sound:%s]' % sound_name
     # TODO: Add user dictionaries (wordsets) as tags
+    return note_fields
+
+
+def fill_note(word, note):
+    """
+    Copy the values of the fields prepared with prepare_note_fields (or compute them now) into the note
+    """
+    note_fields = word.get(NOTE_FIELDS_KEY) or get_note_fields(word)
+    for field in fields:
+        note[field] = note_fields[field]
     return note
 
 
-def add_word(word, model):
-    word_value = word.get('wordValue')
-    if word_value == '':
-        return
+def add_words(words, model, plan, note_map):
+    """
+    Add or update the notes of many words as one operation with one undo entry
+    :param words: list of words
+    :param model: LinguaLeo_model
+    :param plan: ImportPlan
+    :param note_map: NoteMap to remember the notes of added words
+    :return: dict with number of words for each result of add_word
+    """
     collection = mw.col
-    note = notes.Note(collection, model)
-    note = fill_note(word, note)
+    counts = {}
+    index = get_duplicate_index(collection)
+    undo_id = start_undo_entry(collection)
+    for word in words:
+        result = add_word(word, model, plan, note_map, index)
+        counts[result] = counts.get(result, 0) + 1
+    finish_undo_entry(collection, undo_id)
+    if index:
+        # Added notes are already in the index
+        index.update_signature(collection)
+    return counts
+
+
+def start_undo_entry(collection):
+    """
+    :return: id of the undo entry to merge the changes into (Anki 2.1.45+) or None
+    """
+    if hasattr(collection, 'add_custom_undo_entry'):
+        return collection.add_custom_undo_entry(UNDO_LABEL)
+    # Earlier versions create an undo entry with a checkpoint
+    if hasattr(mw, 'checkpoint'):
+        mw.checkpoint(UNDO_LABEL)
+    return None
 
-    note_dupes = get_duplicates(word_value)
 
-    if not note_dupes:
-        collection.addNote(note)
-    else:
-        for nid in note_dupes:
-            note_in_db = notes.Note(collection, id=nid)
-            note_in_db['ru'] = note['ru']
-            note_in_db['context'] = note['context']
-            note_in_db['transcription'] = note['transcription']
-            note_in_db['picture_name'] = note['picture_name']
-            note_in_db['sound_name'] = note['sound_name']
-            note_in_db.flush()
-            # TODO: Update tags (user wordsets) when implemented
-    # TODO: Check if it is possible to update Anki's media collection to remove old (unused) media
+def finish_undo_entry(collection, undo_id):
+    if undo_id is not None:
+        collection.merge_undo_entries(undo_id)
+    # Earlier versions undo a checkpoint by rolling back the changes that weren't saved yet,
+    # so the collection is not saved here: it's saved by the next checkpoint or Anki's autosave
 
 
-def get_duplicates(word_value):
+def add_word(word, model, plan, note_map, index=None):
+    """
+    Add a note for the word or update the note it was imported to before, as planned
+    :param plan: ImportPlan
+    :param note_map: NoteMap to remember the note of added word
+    :param index: DuplicateIndex to keep up to date
+    :return: importplan.ADD, importplan.UPDATE, importplan.UNCHANGED or importplan.SKIP
+    """
+    action, note_id = plan.get(word)
+    if action == importplan.SKIP:
+        return action
     collection = mw.col
-    # escape backslash
-    if '\\' in word_value:
-        word_value = word_value.replace('\\', '\\\\')
-    try:
-        # check for sentences or words containing double quotes
-        if '"' in word_value:
-            if anki_version > 23:
-                escaped = word_value.replace('"', '\\"')
-                # Note: We can't search for 'en' field when there are escaped double quotes
-                note_dupes = collection.findNotes('"%s"' % escaped)
-            else:
-                # Support Anki < 2.1.24, where searching with single quotes was still allowed
-                note_dupes = collection.findNotes("en:'%s'" % word_value)
+
+    if action == importplan.ADD:
+        note = notes.Note(collection, model)
+        note = fill_note(word, note)
+        if hasattr(collection, 'add_note'):
+            # Undoable operation since Anki 2.1.45, merged into the undo entry of the batch
+            collection.add_note(note, model['did'])
         else:
-            note_dupes = collection.findNotes('en:"%s"' % word_value)
-    except InvalidInput:
-        # TODO: find a better solution for this fix
-        problem = "The word '{}' contains unexpected symbols and it can't be checked for duplicates. " \
-                  "Please open an issue on GitHub: https://github.com/vi3itor/lingualeoanki/issues/new".format(word_value)
-        showInfo(problem)
-        return None
+            collection.addNote(note)
+        note_map.set(word.get('id'), note.id)
+        if index:
+            index.add(strip_html_media(note['en']), note.id)
+        return action
+    note_fields = word.get(NOTE_FIELDS_KEY) or get_note_fields(word)
+    note_in_db = notes.Note(collection, id=note_id)
+    changed_fields = [field for field in fields if note_in_db[field] != note_fields[field]]
+    if not changed_fields:
+        # Saving unchanged note would only update its modification time and make the next sync longer
+        return importplan.UNCHANGED
+    if index and 'en' in changed_fields:
+        index.remove(strip_html_media(note_in_db['en']), note_id)
+        index.add(strip_html_media(note_fields['en']), note_id)
+    for field in changed_fields:
+        note_in_db[field] = note_fields[field]
+    if hasattr(collection, 'update_note'):
+        # Unlike flush, it is undoable and gets into the undo entry of the batch
+        collection.update_note(note_in_db)
+    else:
+        note_in_db.flush()
+    # TODO: Update tags (user wordsets) when implemented
+    # TODO: Check if it is possible to update Anki's media collection to remove old (unused) media
+    return action
 
-    # TODO: Check why findNotes returns duplicated note ids
-    #  there might be a different function to find unique note ids
-    # Cast protobuf sequence to list, then exclude duplicates
-    return set(list(note_dupes)) if note_dupes else None
 
+def find_duplicates(collection, word_values, exact=False):
+    """
+    Find notes of LinguaLeo_model for many words at once.
+    Words are compared in normalized form, see dupindex.normalize
+    :param collection: Anki collection
+    :param word_values: list of str
+    :param exact: find only the notes with exactly the same value
+    :return: dict of word value -> set of note ids (only for the words that exist)
+    """
+    index = get_duplicate_index(collection)
+    return index.find(word_values, exact) if index else {}
 
-def is_duplicate(word_value):
+
+def get_duplicate_index(collection):
     """
-    Check if the word exists in collection
-    :param word_value: str
-    :return: bool
+    Returns the index of existing notes by their 'en' field.
+    It's built on the first use and rebuilt only if the notes were changed outside the add-on
+    :return: DuplicateIndex or None if there is no LinguaLeo_model
     """
-    if word_value == '':
-        return True
-    return True if get_duplicates(word_value) else False
+    model = collection.models.byName('LinguaLeo_model')
+    if not model:
+        return None
+    index = duplicate_indexes.get(collection.path)
+    if not index or index.model_id != model['id'] or not index.is_valid(collection):
+        index = dupindex.DuplicateIndex(model['id'])
+        index.build(collection, get_first_field)
+        duplicate_indexes[collection.path] = index
+    return index
+
+
+def get_first_field(note_fields):
+    """
+    :param note_fields: fields of the note as they are stored in the database
+    :return: text of the first field without html
+    """
+    return strip_html_media(note_fields.split('\x1f')[0])
 
 
 def is_valid_ascii(url):
@@ -295,10 +566,11 @@ def get_addon_dir():
     return addon_dir
 
 
-def get_cookies_path():
+def get_user_files_path(file_name):
     """
-    Returns a full path to cookies.txt in the user_files folder
-    :return:
+    Returns a full path to the file in the user_files folder
+    :param file_name: str
+    :return: str or None if the folder can't be created
     """
     # user_files folder in the current addon's dir
     uf_dir = os.path.join(get_addon_dir(), 'user_files')
@@ -309,7 +581,52 @@ def get_cookies_path():
         except:
             # TODO: Improve error handling
             return None
-    return os.path.join(uf_dir, 'cookies.txt')
+    return os.path.join(uf_dir, file_name)
+
+
+def get_cookies_path():
+    """
+    Returns a full path to cookies.txt in the user_files folder
+    :return:
+    """
+    return get_user_files_path('cookies.txt')
+
+
+def get_snapshot_path(email):
+    """
+    Returns a full path to the snapshot of the user's vocabulary in the user_files folder.
+    Snapshot is kept for each account, but email itself is not used in the file name.
+    :param email: str
+    :return: str or None
+    """
+    account = hashlib.sha1(email.strip().lower().encode('utf-8')).hexdigest()[:12]
+    return get_user_files_path('snapshot_{}.json'.format(account))
+
+
+def get_note_map_path(collection):
+    """
+    Returns a full path to the mapping of LinguaLeo word ids to note ids of the collection.
+    Every Anki profile has its own collection and its own mapping.
+    :param collection: Anki collection
+    :return: str or None
+    """
+    name = hashlib.sha1(collection.path.encode('utf-8')).hexdigest()[:12]
+    return get_user_files_path('note_ids_{}.json'.format(name))
+
+
+def get_broken_links_path():
+    """
+    Returns a full path to the media links found broken during previous imports
+    :return: str or None
+    """
+    return get_user_files_path('broken_links.json')
+
+
+def clean_broken_links():
+    try:
+        os.remove(get_broken_links_path())
+    except OSError:
+        pass
 
 
 def clean_cookies():
@@ -0,0 +1,59 @@
+"""
+Merging of words received from several wordsets.
+LinguaLeo returns the same word in every wordset it belongs to,
+so words are merged keeping only the first occurrence of each of them.
+This module doesn't depend on Anki and can be used on its own (see benchmarks).
+"""
+
+
+class UniqueWords(object):
+    """
+    List of words without repetitions that keeps the order in which the words were first seen.
+    Ids of added words are kept in a set, so checking a word doesn't depend on the number of words.
+    """
+    def __init__(self, by_lemma=False):
+        """
+        :param by_lemma: also treat words with the same wordLemmaId as repeating
+        """
+        self.by_lemma = by_lemma
+        self.words = []
+        self.ids = set()
+        self.lemma_ids = set()
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        if word.get('id') in self.ids:
+            return True
+        lemma_id = word.get('wordLemmaId') if self.by_lemma else None
+        return bool(lemma_id) and lemma_id in self.lemma_ids
+
+    def add(self, word):
+        """
+        :param word: dict
+        :return: True if the word was added, False if it repeats one of the words
+        """
+        if word in self:
+            return False
+        self.words.append(word)
+        self.ids.add(word.get('id'))
+        if self.by_lemma and word.get('wordLemmaId'):
+            self.lemma_ids.add(word['wordLemmaId'])
+        return True
+
+    def extend(self, words):
+        for word in words:
+            self.add(word)
+
+
+def get_unique_words(word_lists, by_lemma=False):
+    """
+    :param word_lists: lists of words in the order they should be merged
+    :param by_lemma: see UniqueWords
+    :return: list of unique words
+    """
+    unique_words = UniqueWords(by_lemma)
+    for words in word_lists:
+        unique_words.extend(words)
+    return unique_words.words